@@ -0,0 +1,4 @@
+"""Benchmarks for giki's hot paths.
+
+Run them with `python -m bench.run`; see `bench.run` for the options.
+"""
@@ -0,0 +1,102 @@
+"""Synthetic wiki repositories for the benchmarks.
+
+Each generator creates a bare repository at `path` and returns a `Wiki` for
+it. Objects are written directly rather than through `WikiPage.save`, so
+generating even large repositories is quick.
+"""
+from __future__ import unicode_literals
+import os
+from dulwich.repo import Repo
+from dulwich.objects import Blob, Tree
+
+from giki.core import Wiki
+
+AUTHOR = 'Bench Marker <bench@example.com>'
+
+def _init(path):
+    os.mkdir(path)
+    Repo.init_bare(path)
+    return Wiki(path)
+
+def _commit(wiki, pages, parent=None, message='Generated'):
+    """Commits `pages`, a dict mapping page paths to (fmt, content), on top
+    of `parent` and points the branch at the result.
+    """
+    changes = {}
+    for path, (fmt, content) in pages.items():
+        blob = Blob.from_string(content.encode('utf-8'))
+        wiki._repo.object_store.add_object(blob)
+        path_list = path.split('/')
+        filename = '.'.join((path_list[-1], fmt)).encode('utf-8')
+        changes[(tuple(path_list[:-1]), filename)] = (0100644, blob.id)
+
+    if parent is None:
+        empty = Tree()
+        wiki._repo.object_store.add_object(empty)
+        root_tree = wiki._build_tree(empty.id, changes)
+        parents = []
+    else:
+        root_tree = wiki._build_tree(wiki._get_object(parent).tree, changes)
+        parents = [parent]
+    commit_id = wiki._do_commit(root_tree, parents, AUTHOR, 0, message)
+    wiki._repo.refs[wiki._ref] = commit_id
+    return commit_id
+
+def text(fmt, paragraphs):
+    """Returns a page of roughly `paragraphs` paragraphs of markup."""
+    words = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+            'eiusmod tempor incididunt ut labore et dolore magna aliqua')
+    out = []
+    for i in range(paragraphs):
+        if i % 10 == 0:
+            heading = 'Section {}'.format(i)
+            out.append({
+                'mdown': '## {}'.format(heading),
+                'rst': '{}\n{}'.format(heading, '-' * len(heading)),
+                'textile': 'h2. {}'.format(heading),
+                'html': '<h2>{}</h2>'.format(heading),
+            }[fmt])
+        if fmt == 'html':
+            out.append('<p>{} {}</p>'.format(words, i))
+        else:
+            out.append('{} {}'.format(words, i))
+    return '\n\n'.join(out) + '\n'
+
+def wide(path, pages=5000):
+    """One directory holding `pages` pages."""
+    wiki = _init(path)
+    _commit(wiki, dict(('wide/page{}'.format(i), ('mdown', text('mdown', 3)))
+        for i in range(pages)))
+    return wiki
+
+def deep(path, depth=30):
+    """A single page `depth` directories down, with a sibling at each level.
+    """
+    wiki = _init(path)
+    pages = {}
+    for i in range(depth):
+        directory = '/'.join('d{}'.format(j) for j in range(i + 1))
+        pages[directory + '/sibling'] = ('mdown', text('mdown', 1))
+    pages[directory + '/page'] = ('mdown', text('mdown', 3))
+    _commit(wiki, pages)
+    return wiki
+
+def long_history(path, commits=5000):
+    """`commits` successive edits, alternating between two pages."""
+    wiki = _init(path)
+    head = _commit(wiki, {
+        'index': ('mdown', text('mdown', 3)),
+        'other': ('mdown', text('mdown', 3)),
+    })
+    for i in range(commits):
+        page = 'index' if i % 2 else 'other'
+        head = _commit(wiki, {page: ('mdown', text('mdown', 3) + str(i))},
+                parent=head)
+    return wiki
+
+def large_pages(path, paragraphs=2000):
+    """One large page in each format."""
+    wiki = _init(path)
+    _commit(wiki, dict(('large/{}'.format(fmt), (fmt, text(fmt, paragraphs)))
+        for fmt in ('mdown', 'rst', 'textile', 'html')))
+    return wiki
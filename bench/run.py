@@ -0,0 +1,199 @@
+"""Runs the benchmarks and saves the results as JSON.
+
+    python -m bench.run [-o results.json] [--compare old.json] [-k filter]
+
+Each benchmark is timed over several repetitions, and the minimum, median
+and mean are recorded in seconds. With `--compare`, the ratio of each median
+to the one in an earlier results file is printed too, so regressions between
+releases stand out.
+"""
+from __future__ import unicode_literals
+import argparse
+import json
+import platform
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+from giki import formatter
+from giki.core import Wiki
+from giki.web import SingleUserWiki
+from . import repos
+
+BENCHMARKS = []
+
+def benchmark(repeat=10, number=1):
+    """Registers a benchmark.
+
+    The decorated function takes a scratch directory and returns a callable
+    to be timed; setup work done before returning isn't counted. Each of the
+    `repeat` samples is the mean of `number` calls.
+    """
+    def decorator(func):
+        BENCHMARKS.append((func.__name__, func, repeat, number))
+        return func
+    return decorator
+
+def measure(func, repeat, number):
+    samples = []
+    for i in range(repeat):
+        start = time()
+        for j in range(number):
+            func()
+        samples.append((time() - start) / number)
+    samples.sort()
+    return {
+        'min': samples[0],
+        'median': samples[len(samples) // 2],
+        'mean': sum(samples) / len(samples),
+        'repeat': repeat,
+        'number': number,
+    }
+
+#####
+# CORE
+
+@benchmark(number=100)
+def get_page_wide(tmp):
+    wiki = repos.wide(os.path.join(tmp, 'repo'))
+    return lambda: wiki.get_page('wide/page2500')
+
+@benchmark(number=10)
+def get_page_wide_cold(tmp):
+    path = os.path.join(tmp, 'repo')
+    repos.wide(path)
+    return lambda: Wiki(path).get_page('wide/page2500')
+
+@benchmark(number=100)
+def get_page_deep(tmp):
+    wiki = repos.deep(os.path.join(tmp, 'repo'))
+    path = '/'.join('d{}'.format(i) for i in range(30)) + '/page'
+    return lambda: wiki.get_page(path)
+
+@benchmark(number=10)
+def get_page_deep_cold(tmp):
+    repo = os.path.join(tmp, 'repo')
+    repos.deep(repo)
+    path = '/'.join('d{}'.format(i) for i in range(30)) + '/page'
+    return lambda: Wiki(repo).get_page(path)
+
+@benchmark(number=10)
+def save(tmp):
+    wiki = repos.wide(os.path.join(tmp, 'repo'))
+    def run():
+        p = wiki.get_page('wide/page2500')
+        p.content += 'edit\n'
+        p.save(repos.AUTHOR, 'Edit')
+    return run
+
+@benchmark(number=10)
+def save_merge(tmp):
+    """Saves an edit made on a commit the branch has since moved on from."""
+    wiki = repos.long_history(os.path.join(tmp, 'repo'))
+    def run():
+        p1 = wiki.get_page('index')
+        p2 = wiki.get_page('other')
+        p1.content += 'edit\n'
+        p1.save(repos.AUTHOR, 'Edit')
+        p2.content += 'edit\n'
+        p2.save(repos.AUTHOR, 'Concurrent edit')
+    return run
+
+@benchmark(repeat=5)
+def history(tmp):
+    wiki = repos.long_history(os.path.join(tmp, 'repo'), commits=1000)
+    return lambda: list(wiki.get_page('index').history())
+
+#####
+# FORMATTER
+
+def _format_benchmark(fmt):
+    def func(tmp):
+        page = repos.large_pages(os.path.join(tmp, 'repo')).get_page(
+                'large/' + fmt)
+        return lambda: formatter.format(page)
+    func.__name__ = str('format_' + fmt)
+    benchmark(repeat=5)(func)
+
+for fmt in ('mdown', 'rst', 'textile', 'html'):
+    _format_benchmark(fmt)
+
+@benchmark(repeat=5)
+def postprocess(tmp):
+    page = repos.large_pages(os.path.join(tmp, 'repo')).get_page('large/mdown')
+    html = formatter.formatter.for_extension('mdown').format(page.content)
+    return lambda: formatter.pipeline.process(html)
+
+#####
+# WEB
+
+def _client(wiki):
+    return Client(SingleUserWiki(wiki, repos.AUTHOR), BaseResponse)
+
+@benchmark(number=100)
+def wsgi_page(tmp):
+    client = _client(repos.wide(os.path.join(tmp, 'repo')))
+    return lambda: client.get('/wide/page2500')
+
+@benchmark(repeat=5)
+def wsgi_large_page_uncached(tmp):
+    wiki = repos.large_pages(os.path.join(tmp, 'repo'))
+    def run():
+        _client(wiki).get('/large/rst')
+    return run
+
+@benchmark(number=100)
+def wsgi_not_found(tmp):
+    client = _client(repos.wide(os.path.join(tmp, 'repo')))
+    return lambda: client.get('/wide/nope')
+
+#####
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the giki benchmarks')
+    parser.add_argument('-o', '--output', metavar='FILE', default=None,
+            help='File to save the results to as JSON')
+    parser.add_argument('--compare', metavar='FILE', default=None,
+            help='Earlier results file to compare against')
+    parser.add_argument('-k', dest='filter', metavar='TEXT', default='',
+            help='Only run benchmarks whose names contain TEXT')
+    args = parser.parse_args()
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+
+    results = {}
+    for name, func, repeat, number in BENCHMARKS:
+        if args.filter not in name:
+            continue
+        tmp = mkdtemp()
+        try:
+            results[name] = measure(func(tmp), repeat, number)
+        finally:
+            rmtree(tmp)
+
+        line = '{:30} {:10.3f} ms'.format(name,
+                results[name]['median'] * 1000)
+        if name in previous:
+            line += '  x{:.2f}'.format(
+                    results[name]['median'] / previous[name]['median'])
+        print line
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'formatter_version': formatter.VERSION,
+                'time': time(),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
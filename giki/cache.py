@@ -0,0 +1,132 @@
+"""Caches for work derived from Git objects.
+
+Git objects are content-addressed, so anything computed purely from an
+object's SHA never goes stale; these caches only have to decide how much to
+keep around.
+"""
+from __future__ import unicode_literals
+import os
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from dulwich.lru_cache import LRUCache as _LRUCache, LRUSizeCache
+
+from . import formatter
+from .stats import timer, current as current_timings
+
+class LRUCache (object):
+    """A thread-safe least-recently-used cache.
+
+    If `max_size` is given, entries are evicted once the total `len()` of the
+    stored values exceeds it; otherwise at most `max_entries` are kept.
+    """
+
+    def __init__(self, max_entries=1000, max_size=None):
+        if max_size is None:
+            self._cache = _LRUCache(max_cache=max_entries)
+        else:
+            self._cache = LRUSizeCache(max_size=max_size)
+        self._lock = Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            return self._cache.get(key, default)
+
+    def set(self, key, value):
+        with self._lock:
+            self._cache.add(key, value)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._cache
+
+    def __len__(self):
+        with self._lock:
+            return len(self._cache)
+
+
+class RenderCache (object):
+    """Caches the HTML produced by `formatter.format` for wiki pages.
+
+    Entries are keyed by the page's blob SHA, its format and
+    `formatter.VERSION`, so an edit, a rename to another format or an upgrade
+    of the formatter all miss the cache rather than serving stale HTML.
+
+    @param max_size Approximate number of bytes to hold in memory.
+    @param path Optional directory to use as a second, on-disk tier. It is
+    safe for several processes to share the same directory.
+    @param renderer Object whose `format(page, timed)` method renders pages,
+    such as a `formatter.RenderPool`. Defaults to the `formatter` module
+    itself.
+    """
+
+    def __init__(self, max_size=32*1024*1024, path=None, renderer=None):
+        self.renderer = renderer if renderer is not None else formatter
+        self._memory = LRUCache(max_size=max_size)
+        self.path = path
+        if path is not None and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def key(self, page):
+        return '{}.{}.{}'.format(page.blob_id, page.fmt, formatter.VERSION)
+
+    def get(self, key):
+        """Returns the byte string stored under `key`, or None."""
+        value = self._memory.get(key)
+        if value is None and self.path is not None:
+            try:
+                with open(self._disk_path(key), 'rb') as f:
+                    value = f.read()
+            except IOError:
+                return None
+            self._memory.set(key, value)
+        return value
+
+    def set(self, key, value):
+        """Stores the byte string `value` under `key` in every tier."""
+        self._memory.set(key, value)
+        if self.path is not None:
+            self._write(self._disk_path(key), value)
+
+    def lookup(self, page):
+        """Returns the cached HTML for `page`, or None if it isn't cached."""
+        html = self.get(self.key(page))
+        if html is not None:
+            return html.decode('utf-8')
+        return None
+
+    def render(self, page):
+        """Returns the formatted HTML for `page`, rendering it on a miss."""
+        html = self.lookup(page)
+        if html is None:
+            try:
+                with timer('format', page.fmt):
+                    # break down where the time went, if anyone's looking
+                    html = self.renderer.format(page,
+                            timed=current_timings() is not None)
+            except formatter.RenderFailed as e:
+                return e.html
+            self.set(self.key(page), html.encode('utf-8'))
+        return html
+
+    def _disk_path(self, key):
+        return os.path.join(self.path, key[:2], key[2:])
+
+    def _write(self, path, value):
+        # write to a temporary file and rename it into place, so concurrent
+        # readers never see a partial entry
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                pass # someone else just made it
+        f = NamedTemporaryFile(dir=directory, delete=False)
+        try:
+            f.write(value)
+        finally:
+            f.close()
+        os.rename(f.name, path)
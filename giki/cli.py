@@ -1,8 +1,22 @@
 import argparse
+import sys
 from .core import Wiki
+from .cache import RenderCache
+from .formatter import RenderPool
 from .web import SingleUserWiki, MultiUserWiki
+from .server import Server, GeventServer
+from .export import Exporter
+from .prerender import Prerenderer
+from .maintenance import Maintainer
+from .stats import Stats
 
 def main():
+    # subcommands come first; anything else is an author to serve as
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
+    serve(sys.argv[1:])
+
+def serve(argv):
     parser = argparse.ArgumentParser(
 			description='Run a single user Git wiki server')
     parser.add_argument('author', metavar='AUTHOR', type=str,
@@ -13,21 +27,180 @@ def main():
 			default='.', help='Path to the Git bare repo')
     parser.add_argument('-m, --multiuser', dest='multiuser',
             action='store_true')
-    args = parser.parse_args()
-    
-    wiki = Wiki(args.path)
+    parser.add_argument('--render-cache', dest='render_cache', metavar='DIR',
+            type=str, default=None,
+            help='Directory to keep rendered pages in between runs')
+    parser.add_argument('--render-processes', dest='render_processes',
+            metavar='N', type=int, default=0,
+            help='Render pages in a pool of N processes')
+    parser.add_argument('--template-cache', dest='template_cache',
+            metavar='DIR', type=str, default=None,
+            help='Directory to keep compiled templates in between runs')
+    parser.add_argument('--compress', dest='compress', action='store_true',
+            help='Compress responses for clients that accept gzip or brotli')
+    parser.add_argument('--bind', dest='bind', metavar='ADDRESS', type=str,
+            default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--workers', dest='workers', metavar='N', type=int,
+            default=0, help='Serve from N worker processes; by default, the '
+            'development server is used')
+    parser.add_argument('--threads', dest='threads', metavar='N', type=int,
+            default=8, help='Requests each worker handles at once')
+    parser.add_argument('--keep-alive', dest='keep_alive', metavar='SECONDS',
+            type=int, default=5, help='How long to keep idle connections open')
+    parser.add_argument('--prerender', dest='prerender', action='store_true',
+            help='Render changed pages in the background as the wiki changes')
+    parser.add_argument('--gevent', dest='gevent', action='store_true',
+            help='Serve connections from gevent greenlets, passing blocking '
+            'work to the --threads pool')
+    parser.add_argument('--maintain', dest='maintain', action='store_true',
+            help='Pack loose objects in the background while serving')
+    parser.add_argument('--maintain-interval', dest='maintain_interval',
+            metavar='SECONDS', type=int, default=600,
+            help='How often to check for loose objects')
+    _add_maintain_arguments(parser)
+    parser.add_argument('--stats', dest='stats', action='store_true',
+            help='Time requests, sending Server-Timing headers and reporting '
+            'latencies at /+stats')
+    args = parser.parse_args(argv)
 
-    if args.multiuser:
-        app = MultiUserWiki(wiki)
-    else:
-        app = SingleUserWiki(wiki, args.author)
+    def make_app():
+        # called in each worker, so every process opens the repo itself
+        wiki = Wiki(args.path)
+        renderer = None
+        if args.render_processes:
+            renderer = RenderPool(args.render_processes)
+        render_cache = RenderCache(path=args.render_cache, renderer=renderer)
+        if args.prerender:
+            Prerenderer(wiki, render_cache).start()
+        if args.maintain:
+            Maintainer(wiki, loose_threshold=args.loose_threshold,
+                    batch_size=args.batch_size,
+                    interval=args.maintain_interval).start()
+
+        if args.multiuser:
+            app = MultiUserWiki(wiki, render_cache=render_cache,
+                    template_cache=args.template_cache)
+        else:
+            app = SingleUserWiki(wiki, args.author, render_cache=render_cache,
+                    template_cache=args.template_cache)
+
+        # keep Last-Modified for pages up to date without making page
+        # views wait for it
+        app.last_modified.start()
+        app.debug = not (args.workers or args.gevent)
+        app.compress = args.compress
+        if args.stats:
+            app.stats = Stats()
+        app.precompile_templates()
+        return app
+
+    print "Starting wiki at http://{}:{}/. ^C to exit.".format(args.bind,
+            args.port)
+
+    if args.workers or args.gevent:
+        server_class = GeventServer if args.gevent else Server
+        server_class(make_app, args.bind, args.port, workers=args.workers,
+                threads=args.threads, keep_alive=args.keep_alive
+                ).serve_forever()
+        print "Goodbye!"
+        return
 
-    app.debug = True
-    
-    print "Starting wiki at http://localhost:{}/. ^C to exit.".format(args.port)
-    
     try:
-        app.serve(args.port)
+        make_app().serve(args.port, args.bind)
     except KeyboardInterrupt:
         print
         print "Goodbye!"
+
+def export(argv):
+    parser = argparse.ArgumentParser(prog='giki export',
+            description='Export the wiki as a static site, rendering only '
+            'the pages changed since the last export')
+    parser.add_argument('output', metavar='DIR', type=str,
+            help='Directory to write the site to')
+    parser.add_argument('-P', '--path', dest='path', metavar='PATH', type=str,
+            default='.', help='Path to the Git bare repo')
+    parser.add_argument('-r', '--ref', dest='ref', metavar='REF', type=str,
+            default='refs/heads/master', help='Ref to export')
+    parser.add_argument('-j', '--processes', dest='processes', metavar='N',
+            type=int, default=None,
+            help='Render in N processes; defaults to the number of CPUs')
+    args = parser.parse_args(argv)
+
+    exporter = Exporter(Wiki(args.path, args.ref), args.output,
+            processes=args.processes)
+    rendered, removed = exporter.export()
+    print "Exported {} pages, removed {}.".format(len(rendered), len(removed))
+
+def prerender(argv):
+    parser = argparse.ArgumentParser(prog='giki prerender',
+            description='Render the pages changed by an update into the '
+            'render cache. With no commits given, reads "OLD NEW REF" lines '
+            'from standard input, so it can be run from a post-receive hook.')
+    parser.add_argument('commits', metavar='COMMIT', type=str, nargs='*',
+            help='The old and new commits of the branch')
+    parser.add_argument('-P', '--path', dest='path', metavar='PATH', type=str,
+            default='.', help='Path to the Git bare repo')
+    parser.add_argument('-r', '--ref', dest='ref', metavar='REF', type=str,
+            default='refs/heads/master', help='Ref the wiki is on')
+    parser.add_argument('--render-cache', dest='render_cache', metavar='DIR',
+            type=str, required=True, help='Render cache directory to fill')
+    parser.add_argument('--render-processes', dest='render_processes',
+            metavar='N', type=int, default=0,
+            help='Render pages in a pool of N processes')
+    args = parser.parse_args(argv)
+
+    if args.commits:
+        if len(args.commits) != 2:
+            parser.error('give both the old and new commits, or neither')
+        updates = [args.commits]
+    else:
+        updates = [line.split()[:2] for line in sys.stdin
+                if line.split()[2:3] == [args.ref]]
+
+    renderer = None
+    if args.render_processes:
+        renderer = RenderPool(args.render_processes)
+    prerenderer = Prerenderer(Wiki(args.path, args.ref),
+            RenderCache(path=args.render_cache, renderer=renderer))
+    for old_id, new_id in updates:
+        if new_id == '0' * 40:
+            continue # the branch was deleted
+        if old_id == '0' * 40:
+            old_id = None
+        count = prerenderer.prerender(old_id, new_id)
+        print "Rendered {} pages.".format(count)
+    if renderer is not None:
+        renderer.close()
+
+def maintain(argv):
+    parser = argparse.ArgumentParser(prog='giki maintain',
+            description='Pack the loose objects in the wiki\'s repository. '
+            'Safe to run while the wiki is being served.')
+    parser.add_argument('-P', '--path', dest='path', metavar='PATH', type=str,
+            default='.', help='Path to the Git bare repo')
+    parser.add_argument('--auto', dest='auto', action='store_true',
+            help='Only pack if there are more than --loose-threshold loose '
+            'objects, eg when run from cron')
+    _add_maintain_arguments(parser)
+    args = parser.parse_args(argv)
+
+    maintainer = Maintainer(Wiki(args.path),
+            loose_threshold=args.loose_threshold, batch_size=args.batch_size)
+    count = maintainer.maintain(force=not args.auto)
+    if count is None:
+        print "Another maintainer is already running."
+        sys.exit(1)
+    print "Packed {} objects.".format(count)
+
+def _add_maintain_arguments(parser):
+    parser.add_argument('--loose-threshold', dest='loose_threshold',
+            metavar='N', type=int, default=1000,
+            help='Pack once there are about N loose objects')
+    parser.add_argument('--batch-size', dest='batch_size', metavar='N',
+            type=int, default=10000, help='Put at most N objects in each pack')
+
+commands = {
+    'export': export,
+    'maintain': maintain,
+    'prerender': prerender,
+}
@@ -1,7 +1,47 @@
 from __future__ import unicode_literals
+import os
 from dulwich.repo import Repo
 from dulwich.objects import Blob, Commit, Tree
-from time import time
+from errno import EEXIST
+from heapq import heappush, heappop
+from threading import RLock
+from time import sleep, time
+
+from .cache import LRUCache
+from .merge import merge3
+from .stats import timer
+
+class _LockedObjectStore (object):
+    """Wraps a dulwich object store so objects can be read from several
+    threads at once.
+
+    Reading from a pack seeks and reads a file object shared by all its
+    users, so concurrent reads have to take turns.
+    """
+
+    def __init__(self, store):
+        self._store = store
+        self._lock = RLock()
+
+    def __getitem__(self, id):
+        with self._lock:
+            try:
+                return self._store[id]
+            except KeyError:
+                # dulwich looks in the packs before the loose objects, so an
+                # object packed, and its loose copy removed, in between is
+                # missed; looking again finds the new pack, as dulwich lists
+                # the packs again when the pack directory changes
+                return self._store[id]
+
+    def __contains__(self, id):
+        return id in self._store
+
+    def __iter__(self):
+        return iter(self._store)
+
+    def __getattr__(self, name):
+        return getattr(self._store, name)
 
 class Wiki (object):
     """Represents a Giki wiki."""
@@ -10,6 +50,12 @@ class Wiki (object):
     _ref = '' # the ref name to use
     _encoding = 'utf-8'
     default_page = 'index'
+    object_cache_size = 1000 # parsed trees and commits to keep in memory
+    path_cache_size = 10000 # (root tree, path) lookups to keep in memory
+    manifest_cache_size = 1000 # per-tree manifests to keep in memory
+    max_clock_skew = 24 * 60 * 60 # seconds commit times may be out by
+    commit_attempts = 5 # times to try moving the ref before giving up
+    commit_retry_delay = 0.05 # seconds, multiplied by the attempt number
 
     def __init__(self, repo_path, ref_name="refs/heads/master"):
         """Sets up the object.
@@ -19,8 +65,20 @@ class Wiki (object):
         """
 
         self._repo = Repo(repo_path)
+        self._repo.object_store = _LockedObjectStore(self._repo.object_store)
         self._ref = ref_name
 
+        # Trees and commits are immutable and content-addressed, so these
+        # never need invalidating; when the ref moves, lookups simply start
+        # using new keys and the old entries age out.
+        self._objects = LRUCache(max_entries=self.object_cache_size)
+        self._tree_paths = LRUCache(max_entries=self.path_cache_size)
+        self._manifests = LRUCache(max_entries=self.manifest_cache_size)
+
+        self._ref_listeners = []
+        self._seen_head = None
+        self._seen_head_lock = RLock()
+
     def get_page(self, path):
         """Gets the page at a particular path.
 
@@ -48,20 +106,110 @@ class Wiki (object):
         p._load_from_commit(id)
         return p
 
+    def list_directory(self, path, commit_id=None):
+        """Lists the pages and subdirectories in a directory.
+
+        @param path Path to the directory, with `/` between components; ''
+        for the top level.
+        @param commit_id Commit to list the directory at; defaults to the
+        head of the branch.
+        @return a tuple in the form (pages, dirs): a dict mapping the names
+        of the directory's pages to tuples in the form (fmt, blob_id), and a
+        sorted list of the names of its subdirectories. Both are shared
+        between callers and must not be modified.
+        @raises PageNotFound if there is no such directory
+        """
+        if commit_id is None:
+            commit_id = self._resolve_ref(self._ref)
+        root_tree = self._get_object(commit_id).tree
+        path_list = [p for p in path.split('/') if p]
+        try:
+            tree = self._get_subtree(root_tree, path_list)
+        except KeyError:
+            raise PageNotFound()
+        return self._get_manifest(tree)
+
     def create_page(self, path, fmt, author):
         p = WikiPage(self, path)
         p._create(fmt, author)
         return p
 
-    def __get_trees(self, root_tree, path, create=False):
+    def transaction(self, author, change_msg=''):
+        """Starts a set of page changes to be saved in a single commit.
+
+        @return `WikiTransaction` object, meant to be used as a context
+        manager.
+        """
+        return WikiTransaction(self, author, change_msg)
+
+    def _data_path(self, name):
+        """Returns the path to keep giki's own data file `name` in."""
+        return os.path.join(self._repo.controldir(), 'giki', name)
+
+    def add_ref_listener(self, listener):
+        """Arranges for `listener(old_id, new_id)` to be called whenever the
+        wiki's branch moves.
+
+        Moves made through this object are reported straight away; moves made
+        elsewhere (a `git push`, another process) are reported the next time
+        the branch is read. Listeners are called on whichever thread noticed
+        the move, so they should hand any real work off elsewhere.
+        """
+        self._ref_listeners.append(listener)
+
+    def _resolve_ref(self, ref):
+        """Returns the id of the commit `ref` currently points to."""
+        with timer('ref'):
+            id = self._repo.refs[ref]
+        if ref == self._ref:
+            self._saw_head(id)
+        return id
+
+    def _saw_head(self, head):
+        """Notes the head of the branch, telling the ref listeners if it has
+        moved since we last looked.
+        """
+        with self._seen_head_lock:
+            old, self._seen_head = self._seen_head, head
+        if old is not None and old != head:
+            for listener in self._ref_listeners:
+                listener(old, head)
+
+    def _get_object(self, id):
+        """Returns the tree or commit with the given id.
+
+        Objects returned from here are shared between callers and must not be
+        modified.
+        """
+        obj = self._objects.get(id)
+        if obj is None:
+            obj = self._repo.object_store[id]
+            self._objects.set(id, obj)
+        return obj
+
+    def __get_trees(self, root_tree, path):
         """Gets a list of trees specified by `path` relatve to `root_tree`.
 
-        Returns a list of tuples in the form (name, tree_obj).
+        Returns a list of tuples in the form (name, tree_obj). The trees come
+        from the cache and must be left alone.
         """
+        with timer('trees'):
+            root_id = root_tree if type(root_tree) in (str, unicode) else \
+                    root_tree.id
+            key = (root_id, tuple(path))
+            ids = self._tree_paths.get(key)
+            if ids is None:
+                trees = self.__load_trees(root_tree, path)
+                self._tree_paths.set(key, [(i, t.id) for i, t in trees])
+                return trees
+            return [[i, self._get_object(id)] for i, id in ids]
+
+    def __load_trees(self, root_tree, path):
+        """Walks the object store for `__get_trees`."""
         # accept either a string or tree object for the root tree
         if type(root_tree) in (str, unicode):
-            root_tree = self._repo.object_store[root_tree]
-            
+            root_tree = self._get_object(root_tree)
+
         trees = [['', root_tree]]
         
         if len(path) == 0:
@@ -71,47 +219,255 @@ class Wiki (object):
         tree = root_tree
         for i in path:
             i = i.encode(self._encoding)
-            try:
-                tree_type, tree_id = tree[i]
-            except KeyError:
-                if create:
-                    tree = Tree()
-                    trees.append([i, tree])
-                else:
-                    raise
-            else:
-                if tree_type != 040000:
-                    raise KeyError()
-                tree = self._repo.object_store[tree_id]
-                trees.append([i, tree])
+            tree_type, tree_id = tree[i]
+            if tree_type != 040000:
+                raise KeyError()
+            tree = self._get_object(tree_id)
+            trees.append([i, tree])
 
         return trees
 
-    def _get_subtree(self, root_tree, path, create=False):
+    def _get_subtree(self, root_tree, path):
         """Returns a tree object for the subtree given by `path` relative to
         `root_tree`.
+
+        The result is shared with other callers, so must not be modified.
         """
-        trees = self.__get_trees(root_tree, path, create=create)
+        trees = self.__get_trees(root_tree, path)
         return trees[-1][1]
 
-    def _put_subtree(self, root_tree, path, new_tree):
-        """Replaces the subtree at `path` relative to `root_tree` with
-        `new_tree`, then returns the new root tree object.
+    def _get_manifest(self, tree):
+        """Returns a tuple in the form (pages, dirs) describing `tree`, as
+        returned by `list_directory`.
+
+        The manifest is built once per tree id, so finding a page costs the
+        same however many other pages share its directory, and listing a
+        directory again doesn't re-read its tree.
+        """
+        manifest = self._manifests.get(tree.id)
+        if manifest is None:
+            pages = {}
+            dirs = []
+            for mode, name, sha in tree.entries():
+                if mode == 040000:
+                    dirs.append(name.decode(self._encoding))
+                    continue
+                # if it's not a regular or executable file, keep going
+                if mode not in (0100644, 0100755):
+                    continue
+
+                parts = name.decode(self._encoding).split('.')
+                if len(parts) < 2:
+                    continue
+                # entries are sorted, so the first extension found wins
+                pages.setdefault(parts[0], (parts[1], sha))
+            manifest = (pages, sorted(dirs))
+            self._manifests.set(tree.id, manifest)
+        return manifest
+
+    def _get_page_index(self, tree):
+        """Returns a dict mapping the names of the pages in `tree` to tuples
+        in the form (fmt, blob_id).
+        """
+        return self._get_manifest(tree)[0]
+
+    def _find_page(self, root_tree, path_list):
+        """Returns (fmt, blob_id) for the page at `path_list` relative to
+        `root_tree`, or None if there's no such page.
+        """
+        try:
+            subtree = self._get_subtree(root_tree, path_list[:-1])
+            return self._get_page_index(subtree)[path_list[-1]]
+        except KeyError:
+            return None
+
+    def _get_entry(self, root_tree, path, filename):
+        """Returns the (mode, sha) of `filename` in the subtree given by `path`
+        relative to `root_tree`, or None if there is no such file.
+        """
+        try:
+            return tuple(self._get_subtree(root_tree, path)[filename])
+        except KeyError:
+            return None
+
+    def _build_tree(self, root_tree, changes):
+        """Applies `changes` to `root_tree` and returns the new root tree id.
+
+        `changes` is a dict mapping (path, filename) tuples to either a
+        (mode, sha) tuple, or None to remove the file. `path` is a tuple of
+        directory names relative to the root. Trees are rebuilt bottom-up, so
+        each directory is written once no matter how many of its files
+        change; directories left empty are removed.
+        """
+        # work out which files change in each directory, including the
+        # parents of every changed directory
+        dirs = {(): {}}
+        for (path, filename), entry in changes.items():
+            dirs.setdefault(tuple(path), {})[filename] = entry
+            for i in range(len(path)):
+                dirs.setdefault(tuple(path[:i]), {})
+
+        # deepest first, so every child is written before its parent
+        for path in sorted(dirs, key=len, reverse=True):
+            try:
+                tree = self._repo.object_store[
+                        self._get_subtree(root_tree, list(path)).id]
+            except KeyError:
+                tree = Tree()
+
+            for filename, entry in dirs[path].items():
+                if entry is None:
+                    if filename in tree:
+                        del tree[filename]
+                else:
+                    tree[filename] = entry
+
+            if path:
+                name = path[-1].encode(self._encoding)
+                if len(tree) == 0:
+                    dirs[path[:-1]][name] = None
+                else:
+                    self._repo.object_store.add_object(tree)
+                    dirs[path[:-1]][name] = (040000, tree.id)
+
+        self._repo.object_store.add_object(tree)
+        return tree.id
+
+    def _commit_changes(self, parent_id, changes, author, message):
+        """Commits `changes` (as for `_build_tree`) on top of the commit
+        `parent_id`, then moves the branch head to include them.
+
+        If the head has moved on since `parent_id`, the new commit is merged
+        into it. Files that were edited in the meantime are merged line by
+        line, with `parent_id`'s version as the base.
+
+        The head is only moved if it hasn't changed since we looked at it, so
+        concurrent writers (even in other processes) can't lose each other's
+        commits; if it has, the merge is redone against the new head, up to
+        `commit_attempts` times.
+
+        @return id of the commit the changes were made in. If a merge was
+        performed, this is not the branch head.
+        @raises MergeConflict if both sides changed the same lines of a page.
+        @raises ManualMergeRequired if the changes can't be merged for any
+        other reason.
         """
-        trees = self.__get_trees(root_tree, path, create=True)
+        parent_tree = self._get_object(parent_id).tree
+        commit_id = self._do_commit(self._build_tree(parent_tree, changes),
+                [parent_id], author, 0, message)
+
+        for attempt in range(self.commit_attempts):
+            current_head = self._resolve_ref(self._ref)
+            if current_head == parent_id:
+                # make our new commit the head of our branch
+                new_head = commit_id
+            else:
+                new_head = self.__merge(commit_id, parent_id, current_head,
+                        changes, author)
+
+            try:
+                if self._repo.refs.set_if_equals(self._ref, current_head,
+                        new_head):
+                    self._saw_head(new_head)
+                    return commit_id
+            except OSError as e:
+                # someone else holds the ref's lock file; give them a moment
+                if e.errno != EEXIST:
+                    raise
+                sleep(self.commit_retry_delay * (attempt + 1))
 
-        # insert our new subtree into the list
-        trees[-1][1] = new_tree
-        self._repo.object_store.add_object(new_tree)
+        raise ManualMergeRequired("The branch kept moving while we tried to"
+                " update it.")
 
-        # update all the parent trees
-        for i, (_, tree) in reversed(list(enumerate(trees[:-1]))):
-            child_name, child_tree = trees[i+1]
-            tree[child_name] = (040000, child_tree.id)
-            self._repo.object_store.add_object(tree)
+    def __merge(self, commit_id, parent_id, current_head, changes, author):
+        """Creates a commit merging `commit_id`, which made `changes` on top
+        of `parent_id`, into `current_head`.
 
-        # return the root tree
-        return trees[0][1]
+        @return id of the merge commit.
+        """
+        parent_tree = self._get_object(parent_id).tree
+
+        # just raise if there's no commits in common
+        if not self._is_ancestor(parent_id, current_head):
+            raise ManualMergeRequired(
+                    "Current head is not a descendant of new commit's "
+                    "direct parent - did someone rebase?")
+
+        # have any of our files changed since?
+        current_tree = self._get_object(current_head).tree
+        merge_changes = dict(changes)
+        conflicts = {}
+        merged = {}
+        for (path, filename), entry in changes.items():
+            parent_entry = self._get_entry(parent_tree, path, filename)
+            current_entry = self._get_entry(current_tree, path, filename)
+            if current_entry in (parent_entry, entry):
+                continue
+            if current_entry is None:
+                raise ManualMergeRequired("Someone has deleted the page"
+                        " since you started editing.")
+            if entry is None:
+                raise ManualMergeRequired("Someone has edited the page"
+                        " since you deleted it.")
+
+            text, page_conflicts = merge3(self.__read_text(parent_entry),
+                    self.__read_text(entry), self.__read_text(current_entry))
+            if page_conflicts:
+                page_path = '/'.join(path + (
+                        filename.decode(self._encoding).split('.')[0],))
+                conflicts[page_path] = page_conflicts
+                merged[page_path] = text
+            else:
+                blob = Blob.from_string(text.encode(self._encoding))
+                self._repo.object_store.add_object(blob)
+                merge_changes[(path, filename)] = (entry[0], blob.id)
+
+        if conflicts:
+            raise MergeConflict("Someone has edited the page since you"
+                    " started editing", commit_id, current_head, conflicts,
+                    merged)
+
+        merge_tree = self._build_tree(current_tree, merge_changes)
+        return self._do_commit(merge_tree, [commit_id, current_head], author,
+                0, 'Merge edits')
+
+    def __read_text(self, entry):
+        """Returns the decoded content of the blob in a (mode, sha) tree
+        entry, or an empty string if `entry` is None.
+        """
+        if entry is None:
+            return ''
+        return self._repo.object_store[entry[1]].as_raw_string().decode(
+                self._encoding)
+
+    def _is_ancestor(self, ancestor_id, commit_id):
+        """Returns True if `ancestor_id` is `commit_id` or one of its
+        ancestors.
+
+        Commits are visited newest first and at most once each, and a line of
+        history is abandoned once it is older than `ancestor_id` (give or take
+        `max_clock_skew`), so only the commits made since `ancestor_id` are
+        walked however long the history is.
+        """
+        if ancestor_id == commit_id:
+            return True
+
+        cutoff = self._get_object(ancestor_id).commit_time - \
+                self.max_clock_skew
+        seen = set([commit_id])
+        queue = [(-self._get_object(commit_id).commit_time, commit_id)]
+        while queue:
+            _, id = heappop(queue)
+            for parent in self._get_object(id).parents:
+                if parent == ancestor_id:
+                    return True
+                if parent in seen:
+                    continue
+                seen.add(parent)
+                commit_time = self._get_object(parent).commit_time
+                if commit_time >= cutoff:
+                    heappush(queue, (-commit_time, parent))
+        return False
 
     def _do_commit(self, tree, parents, author, timezone, message):
         commit = Commit()
@@ -135,6 +491,8 @@ class WikiPage (object):
     - `fmt` - the file extension, eg `mdown` for Markdown.
     - `path` - the path to the page, not including extension.
     - `commit_id` - the id of the commit this page came from.
+    - `blob_id` - the id of the blob holding the page's content.
+    - `commit_time` - the time of that commit, as a Unix timestamp.
 
     To edit the page, alter `content` and call `store()`. Don't touch the other
     attributes (yet).
@@ -151,6 +509,8 @@ class WikiPage (object):
     _path_list = None
     _name = ''
     commit_id = '' # The commit this page came from before modification
+    blob_id = ''
+    commit_time = None
     _commit = None
     _orig_content = '' # For comparing to see if it's actually changed
 
@@ -163,8 +523,8 @@ class WikiPage (object):
         self._name = self._path_list[-1]
 
     def _create(self, fmt, author):
-        self.commit_id = self._repo.ref(self.wiki._ref)
-        self._commit = self._repo.commit(self.commit_id)
+        self.commit_id = self.wiki._resolve_ref(self.wiki._ref)
+        self._commit = self.wiki._get_object(self.commit_id)
 
         try:
             self._find_blob()
@@ -180,41 +540,43 @@ class WikiPage (object):
                 'Created {}'.format(self.path).encode(self.wiki._encoding))
 
     def _load(self):
-        id = self._repo.ref(self.wiki._ref)
+        id = self.wiki._resolve_ref(self.wiki._ref)
         self._load_from_commit(id)
 
     def _load_from_ref(self, ref):
-        id = self._repo.ref(ref)
+        id = self.wiki._resolve_ref(ref)
         self._load_from_commit(id)
 
     def _load_from_commit(self, commit_id):
         self.commit_id = commit_id
-        self._commit = self._repo.commit(commit_id)
+        self._commit = self.wiki._get_object(commit_id)
+        self.commit_time = self._commit.commit_time
         blob = self._find_blob()
 
+        self.blob_id = blob.id
         self.content = blob.as_raw_string().decode(self.wiki._encoding)
         self._orig_content = self.content
 
     def _find_blob(self):
         # find a blob that matches our page's name, and discover its format
-        try:
-            subtree = self.wiki._get_subtree(self._commit.tree,
-                    self._path_list[:-1])
-            
-            for mode, name, sha in subtree.entries():
-                # if it's not a regular or executable file, keep going
-                if mode not in (0100644, 0100755):
-                    continue
-
-                # test the name
-                if name.startswith("{}.".format(self._name)):
-                    self.fmt = name.split(".")[1]
-                    return self._repo.object_store[sha]
-        except KeyError:
+        entry = self.wiki._find_page(self._commit.tree, self._path_list)
+        if entry is None:
             raise PageNotFound()
 
-        # if we get to here, we haven't found it
-        raise PageNotFound()
+        self.fmt, sha = entry
+        with timer('blob'):
+            return self._repo.object_store[sha]
+
+    def history(self, start=None):
+        """Lists the commits that changed this page, newest first, starting
+        from `commit_id`.
+
+        @param start List of commit ids to resume from, as returned by
+        `PageHistory.frontier`.
+        @return `PageHistory` iterator.
+        """
+        return PageHistory(self.wiki, self._path_list,
+                start if start is not None else [self.commit_id])
 
     def save(self, author, change_msg=''):
         """Saves a page to the respository.
@@ -241,80 +603,176 @@ class WikiPage (object):
         blob = Blob.from_string(self.content.encode(self.wiki._encoding))
         self._repo.object_store.add_object(blob)
 
-        # grab the tree we're replacing
         full_filename = '.'.join((self._name, self.fmt)).encode(
                 self.wiki._encoding)
-        new_tree = self.wiki._get_subtree(self._commit.tree,
-                self._path_list[:-1], create=True)
+        changes = {
+            (tuple(self._path_list[:-1]), full_filename): (0100644, blob.id),
+        }
+        return self.wiki._commit_changes(self.commit_id, changes, author,
+                change_msg)
+
+class PageHistory (object):
+    """Iterates lazily over the commits that changed a page.
+
+    Like `git log <path>`, merges that took the page unchanged from one of
+    their parents are skipped, and only that parent is followed; history stops
+    where the page was created. Commits are read from the repository as they
+    are needed, so stopping early only costs the commits walked so far.
+    """
 
-        # grab the old blob ID (which we'll use later)
+    def __init__(self, wiki, path_list, start):
+        """Don't call this directly; use `WikiPage.history`."""
+        self.wiki = wiki
+        self._path_list = path_list
+        self._seen = set()
+        self._queue = []
+        for id in start:
+            self._push(id)
+
+    def _push(self, id, entry=None):
+        if id in self._seen:
+            return
+        self._seen.add(id)
+        commit = self.wiki._get_object(id)
+        if entry is None:
+            entry = self.wiki._find_page(commit.tree, self._path_list)
+        if entry is not None:
+            heappush(self._queue, (-commit.commit_time, id, entry))
+
+    def frontier(self):
+        """Returns the ids of the commits the walk would continue from, in
+        order to resume it later with `WikiPage.history`.
+        """
+        return [id for _, id, _ in sorted(self._queue)]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self._queue:
+            _, id, entry = heappop(self._queue)
+            commit = self.wiki._get_object(id)
+
+            parents = []
+            for parent_id in commit.parents:
+                parent = self.wiki._get_object(parent_id)
+                parent_entry = self.wiki._find_page(parent.tree,
+                        self._path_list)
+                if parent_entry == entry:
+                    # the page came from this parent unchanged
+                    self._push(parent_id, parent_entry)
+                    break
+                parents.append((parent_id, parent_entry))
+            else:
+                for parent_id, parent_entry in parents:
+                    if parent_entry is not None:
+                        self._push(parent_id, parent_entry)
+                return commit
+        raise StopIteration()
+
+class WikiTransaction (object):
+    """Collects changes to many pages and saves them in a single commit.
+
+    Use it as a context manager:
+
+        with wiki.transaction(author, 'Nightly import') as t:
+            t.put('imported/page', 'Some content', 'mdown')
+            t.delete('old/page')
+
+    The changes are committed when the block exits normally, and discarded if
+    it raises. Like `WikiPage.save`, the commit is made on top of the branch
+    head as it was when the transaction started, and merged in if the head
+    has moved since.
+
+    After committing, `commit_id` is the id of the commit the changes were
+    made in.
+    """
+
+    def __init__(self, wiki, author, change_msg=''):
+        """Don't call this directly; use `Wiki.transaction`."""
+        self.wiki = wiki
+        self._repo = wiki._repo
+        self.author = author
+        self.change_msg = change_msg
+        self.commit_id = wiki._resolve_ref(wiki._ref)
+        self._root_tree = wiki._get_object(self.commit_id).tree
+        self._pages = {} # path -> (fmt, blob id), or None if deleted
+
+    def _current(self, path):
+        """Returns (fmt, blob id) for `path` including any changes made in
+        this transaction so far, or None if there's no such page.
+        """
+        if path in self._pages:
+            return self._pages[path]
+        return self._original(path)
+
+    def _original(self, path):
+        path_list = path.split('/')
         try:
-            _, old_blob_id = new_tree[full_filename]
+            subtree = self.wiki._get_subtree(self._root_tree, path_list[:-1])
+            return self.wiki._get_page_index(subtree)[path_list[-1]]
         except KeyError:
-            new_file = True
-
-        # insert the new tree into the tree, and save
-        new_tree[full_filename] = (0100644, blob.id)
-        new_root_tree = self.wiki._put_subtree(self._commit.tree,
-                self._path_list[:-1], new_tree)
-
-        # create a commit
-        commit_id = self.wiki._do_commit(new_root_tree, [self.commit_id],
-                author, 0, change_msg)
-
-        # have any other commits been made since this one's parent?
-        if self._repo.refs[self.wiki._ref] != self.commit_id:
-            current_head = self._repo.refs[self.wiki._ref]
-            # walk back through parents to make sure that the old commit is the
-            # merge base. Easiest to do recursively since commits can have many
-            # parents
-            def step(i):
-                if i == self.commit_id:
-                    return True
-                commit = self._repo.object_store[i]
-                for parent in commit.parents:
-                    if step(parent):
-                        return True
-                return False
-            common_base = step(current_head)
-
-            # just raise if there's no commits in common
-            if not common_base:
-                raise ManualMergeRequired(
-                        "Current head is not a descendant of new commit's "
-                        "direct parent - did someone rebase?")
-            else:
-                # has the actual content changed?
-                current_root_tree = self._repo.object_store[current_head].tree
-                current_subtree = self.wiki._get_subtree(current_root_tree,
-                        self._path_list[:-1])
-                try:
-                    current_blob_id = current_subtree[full_filename][1]
-                except KeyError:
-                    raise ManualMergeRequired("Someone has deleted the page"
-                            " since you started editing.")
-                else:
-                    if current_blob_id != old_blob_id:
-                        print current_blob_id, old_blob_id
-                        raise ManualMergeRequired("Someone has edited the page"
-                                " since you started editing")
-                    else:
-                        current_subtree[full_filename] = (0100644, blob.id)
-                        merge_root_tree = self.wiki._put_subtree(
-                                current_root_tree, self._path_list[:-1],
-                                current_subtree)
-                        edit_commit_id = self.wiki._do_commit(merge_root_tree,
-                                [commit_id, current_head], author, 0,
-                                'Merge edits')
-                        self._repo.refs[self.wiki._ref] = edit_commit_id
-                        return
-        else:
-            # make our new commit the head of our branch
-            self._repo.refs[self.wiki._ref] = commit_id
-            return
-        
-        # if we've fallen through to here, there's a bug!
-        raise Exception("This should never happen")
+            return None
+
+    def put(self, path, content, fmt=None):
+        """Creates or replaces the page at `path`.
+
+        @param fmt The page's format. May only be omitted if the page exists
+        already, in which case its format is kept.
+        """
+        if fmt is None:
+            current = self._current(path)
+            if current is None:
+                raise PageNotFound()
+            fmt = current[0]
+
+        # Ensure there's a trailing newline.
+        if content[-1:] != "\n":
+            content += "\n"
+
+        blob = Blob.from_string(content.encode(self.wiki._encoding))
+        self._repo.object_store.add_object(blob)
+        self._pages[path] = (fmt, blob.id)
+
+    def delete(self, path):
+        """Deletes the page at `path`."""
+        if self._current(path) is None:
+            raise PageNotFound()
+        self._pages[path] = None
+
+    def commit(self):
+        """Saves all the changes made so far.
+
+        @return id of the commit the changes were made in.
+        @raises ManualMergeRequired if the changes can't be merged.
+        """
+        changes = {}
+        for path, page in self._pages.items():
+            path_list = path.split('/')
+            dirs = tuple(path_list[:-1])
+            original = self._original(path)
+            if original is not None and (page is None or
+                    page[0] != original[0]):
+                filename = '.'.join((path_list[-1], original[0]))
+                changes[(dirs, filename.encode(self.wiki._encoding))] = None
+            if page is not None:
+                filename = '.'.join((path_list[-1], page[0]))
+                changes[(dirs, filename.encode(self.wiki._encoding))] = (
+                        0100644, page[1])
+        self._pages = {}
+
+        if changes:
+            self.commit_id = self.wiki._commit_changes(self.commit_id,
+                    changes, self.author, self.change_msg)
+            self._root_tree = self.wiki._get_object(self.commit_id).tree
+        return self.commit_id
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
 
 class PageNotFound (Exception):
     pass
@@ -330,6 +788,27 @@ class ManualMergeRequired (Exception):
     a repo browsing tool, and they might get garbage collected if you leave them
     too long).
 
-    TODO: what to do
+    Edits to different parts of the same page are merged automatically; see
+    `MergeConflict` for when they overlap.
     """
     pass
+
+class MergeConflict (ManualMergeRequired):
+    """Raised if someone else changed the same lines of a page.
+
+    Attributes are as follows:
+
+    - `commit_id` - the id of the unattached commit the changes were saved in.
+    - `head` - the id of the branch head they couldn't be merged into.
+    - `conflicts` - a dict mapping page paths to lists of
+      `giki.merge.Conflict`s.
+    - `merged` - a dict mapping page paths to their merged content, with the
+      conflicting regions marked up, ready to be edited on top of `head`.
+    """
+
+    def __init__(self, message, commit_id, head, conflicts, merged):
+        ManualMergeRequired.__init__(self, message)
+        self.commit_id = commit_id
+        self.head = head
+        self.conflicts = conflicts
+        self.merged = merged
@@ -0,0 +1,190 @@
+"""Exports a wiki as a static site, so it can be served without giki."""
+from __future__ import unicode_literals
+import json
+import os
+from multiprocessing import Pool
+from shutil import copyfile
+from tempfile import NamedTemporaryFile
+
+from .core import Wiki
+from .formatter import VERSION as FORMATTER_VERSION
+from .index import split_filename
+from .web import WebWiki
+
+class Exporter (object):
+    """Writes every page at the head of a wiki's branch to an HTML file at
+    `<path>/<page path>/index.html`, with the default page also at
+    `<path>/index.html`.
+
+    Exports are incremental: a manifest in the output directory records the
+    blob each page was rendered from, and only pages whose blob or format
+    has changed since are rendered again. Pages that have gone are removed.
+
+    Pages are rendered read-only, without the editing and search UI, as
+    there is no server behind them.
+
+    @param wiki The `Wiki` to export.
+    @param path Directory to write the site to.
+    @param processes Number of processes to render pages in; defaults to the
+    number of CPUs. With 1, pages are rendered in this process.
+    @param app_class `WebWiki` subclass whose templates to render with.
+    """
+
+    manifest_name = '.giki-export'
+    version = 1 # bump when the output changes, to re-export everything
+
+    def __init__(self, wiki, path, processes=None, app_class=WebWiki):
+        self.wiki = wiki
+        self.path = path
+        self.processes = processes
+        self.app_class = app_class
+
+    def pages(self, commit_id):
+        """Returns a dict mapping the path of every page at `commit_id` to a
+        tuple in the form (fmt, blob_id).
+        """
+        tree_id = self.wiki._get_object(commit_id).tree
+        pages = {}
+        for entry in self.wiki._repo.object_store.iter_tree_contents(tree_id):
+            if entry.mode not in (0100644, 0100755):
+                continue
+            page = split_filename(entry.path.decode(self.wiki._encoding))
+            if page is not None:
+                # entries are sorted, so the first extension found wins,
+                # as in `Wiki._get_manifest`
+                pages.setdefault(page[0], (page[1], entry.sha))
+        return pages
+
+    def export(self):
+        """Brings the exported site up to date with the wiki.
+
+        @return a tuple of lists of the paths of the pages that were
+        rendered, and of those that were removed.
+        """
+        commit_id = self.wiki._resolve_ref(self.wiki._ref)
+        pages = self.pages(commit_id)
+
+        manifest = self._load_manifest()
+        old_pages = {}
+        if manifest.get('settings') == self._settings():
+            old_pages = dict((path, tuple(entry))
+                    for path, entry in manifest['pages'].items())
+
+        rendered = sorted(path for path, entry in pages.items()
+                if old_pages.get(path) != entry)
+        removed = sorted(path for path in old_pages if path not in pages)
+
+        args = (self.wiki._repo.path, self.wiki._ref, commit_id, self.path,
+                self.app_class)
+        if self.processes == 1 or len(rendered) < 2:
+            _init_worker(*args)
+            for path in rendered:
+                _export_page(path)
+        else:
+            pool = Pool(self.processes, _init_worker, args)
+            try:
+                for path in pool.imap_unordered(_export_page, rendered,
+                        chunksize=16):
+                    pass
+            finally:
+                pool.close()
+                pool.join()
+
+        for path in removed:
+            self._remove_page(path)
+
+        default_page = self.wiki.default_page
+        root_index = os.path.join(self.path, 'index.html')
+        if default_page in rendered or (default_page in pages and
+                not os.path.exists(root_index)):
+            copyfile(_output_path(self.path, default_page), root_index)
+        elif default_page not in pages and os.path.exists(root_index):
+            os.remove(root_index)
+
+        self._save_manifest({
+            'settings': self._settings(),
+            'pages': pages,
+        })
+        return rendered, removed
+
+    def _settings(self):
+        """Everything besides the pages themselves that the output depends
+        on; if any of it changes, every page is exported again.
+        """
+        return {
+            'version': self.version,
+            'formatter': FORMATTER_VERSION,
+            'templates': self.app_class.template_version,
+            'app': '{}.{}'.format(self.app_class.__module__,
+                self.app_class.__name__),
+            'default_page': self.wiki.default_page,
+        }
+
+    def _load_manifest(self):
+        try:
+            with open(os.path.join(self.path, self.manifest_name)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _save_manifest(self, manifest):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        f = NamedTemporaryFile(dir=self.path, delete=False)
+        try:
+            json.dump(manifest, f)
+        finally:
+            f.close()
+        os.chmod(f.name, 0644)
+        os.rename(f.name, os.path.join(self.path, self.manifest_name))
+
+    def _remove_page(self, path):
+        filename = _output_path(self.path, path)
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        # tidy up directories that only held this page
+        directory = os.path.dirname(filename)
+        while directory != os.path.normpath(self.path):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+def _output_path(root, page_path):
+    return os.path.join(root, *(page_path.split('/') + ['index.html']))
+
+# state for the process rendering pages, set up by `_init_worker`
+_worker = None
+
+def _init_worker(repo_path, ref, commit_id, root, app_class):
+    """Sets up a process to render pages; each process opens the
+    repository for itself.
+    """
+    global _worker
+    wiki = Wiki(repo_path, ref)
+    _worker = (wiki, app_class(wiki), commit_id, root)
+
+def _export_page(path):
+    """Renders the page at `path` and writes it to the output directory."""
+    wiki, app, commit_id, root = _worker
+    p = wiki.get_page_at_commit(path, commit_id)
+    context = app.global_ctx(None)
+    context.update(app.page_context(p))
+    context['read_only'] = True
+    html = app.template_env.get_template('page.html').render(**context)
+
+    filename = _output_path(root, path)
+    directory = os.path.dirname(filename)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = NamedTemporaryFile(dir=directory, delete=False)
+    try:
+        f.write(html.encode('utf-8'))
+    finally:
+        f.close()
+    os.chmod(f.name, 0644)
+    os.rename(f.name, filename)
+    return path
@@ -1,11 +1,21 @@
 from __future__ import unicode_literals
+import re
+from multiprocessing import Pipe, Process, TimeoutError, cpu_count
+from threading import Lock, Semaphore
+from . import stats
 from docutils.core import publish_parts
+from .postprocess import (Pipeline, sanitize, table_class, wiki_links,
+        heading_anchors, links as html_links, raw_wiki_links, escape)
 from textile import textile
 try:
     import misaka
 except ImportError:
     from markdown2 import markdown
 
+# Bump this whenever a change here alters the HTML produced for the same
+# input, so that cached renderings are thrown away.
+VERSION = 4
+
 class __Formatter (object):
     def __init__(self):
         self.formats = []
@@ -22,8 +32,22 @@ class __Formatter (object):
 
 formatter = __Formatter()
 
+# Applied, in order, to the output of every format. Add stages with the
+# `pipeline.stage` decorator.
+pipeline = Pipeline([sanitize, table_class, wiki_links, heading_anchors])
+
 class __FormatType (object):
-    pass
+    cpu_bound = True # whether it's worth rendering in another process
+
+    @staticmethod
+    def links(string):
+        """Returns the targets of the links in `string`, read from the markup
+        without rendering it.
+
+        This only finds `[[page]]` links; formats override it to add their
+        own link syntax.
+        """
+        return raw_wiki_links(string)
 
 @formatter.type
 class ReST (__FormatType):
@@ -47,11 +71,22 @@ class ReST (__FormatType):
             writer_name='html'
         )['html_body']
 
+    _link_re = re.compile(r'''
+        `[^`<]*<([^>`\s]+)>`__?           # `text <target>`_
+      | ^\.\.[ ]+_[^:\n]+:[ ]*(\S+)      # .. _name: target
+    ''', re.M | re.X)
+
+    @classmethod
+    def links(cls, string):
+        return [a or b for a, b in cls._link_re.findall(string)] + \
+                raw_wiki_links(string)
+
 @formatter.type
 class Markdown (__FormatType):
     human_name = 'Markdown'
     codemirror_types = ('markdown',)
     extensions = ('mdown', 'markdown', 'md', 'mdn', 'mkdn', 'mkd', 'mdn')
+    cpu_bound = 'misaka' not in globals() # Misaka is C, and fast
     
     @staticmethod
     def format(string):
@@ -73,6 +108,24 @@ class Markdown (__FormatType):
                 'wiki-tables',
             ])
 
+    _code_re = re.compile(r'''
+        ^[ ]{0,3}(`{3,}|~{3,}).*?^[ ]{0,3}\1    # fenced block
+      | `[^`\n]+`                              # code span
+    ''', re.M | re.S | re.X)
+    _link_re = re.compile(r'''
+        (!?)\[[^\]\n]*\]\([ ]*<?([^\s)>]+)     # [text](target), or an image
+      | ^[ ]{0,3}\[[^\]\n]+\]:[ ]*<?([^\s>]+)  # [id]: target
+      | <((?:https?|ftp|mailto):[^\s>]+)>      # <target>
+    ''', re.M | re.X)
+
+    @classmethod
+    def links(cls, string):
+        string = cls._code_re.sub('', string)
+        return [inline or definition or auto
+                for image, inline, definition, auto
+                in cls._link_re.findall(string) if not image] + \
+                raw_wiki_links(string)
+
 @formatter.type
 class Textile (__FormatType):
     human_name = 'Textile'
@@ -81,35 +134,242 @@ class Textile (__FormatType):
     
     format = staticmethod(textile)
 
+    _link_re = re.compile(r'''
+        "[^"\n]+":([^\s<>"]+)     # "text":target
+      | ^\[[^\]\n]+\](\S+)        # [alias]target
+    ''', re.M | re.X)
+
+    @classmethod
+    def links(cls, string):
+        # as in Textile, trailing punctuation isn't part of the link
+        return [(a or b).rstrip('.,;:!?)') for a, b
+                in cls._link_re.findall(string)] + raw_wiki_links(string)
+
 @formatter.type
 class HTML (__FormatType):
     human_name = 'HTML'
     codemirror_types = ()
     extensions = ('html', 'htm')
+    cpu_bound = False
     
     @staticmethod
     def format(string):
         return string
+
+    @staticmethod
+    def links(string):
+        # HTML isn't rendered, so this is only the post-processing
+        return html_links(pipeline.process(string))
     
 
-def format(page):
+def format(page, timed=False):
     """Converts a giki page object into HTML.
-    
-    TODO: remove me and replace all calls to me
-    TODO: implement some sort of post-processor interface for the table thing
+
+    @param timed As for `format_text`.
     """
+    return format_text(page.fmt, page.content, timed)
 
+def format_text(fmt, content, timed=False):
+    """Converts `content`, in the format with extension `fmt`, into HTML.
+
+    @param timed Whether to record how long each stage of `pipeline` takes;
+    see `Pipeline.process`.
+    """
     try:
-        formatted_text = formatter.for_extension(page.fmt).format(page.content)
-        return formatted_text.replace('<table>', '<table class="table">')
+        format = formatter.for_extension(fmt).format
     except KeyError:
-        return "<code><pre>{}</pre></code>".format(
-                page.content.replace('&', '&nbsp;').replace('<', '&lt;'
-                ).replace('>', '&gt;'))
+        return format_plain(content)
+    return pipeline.process(format(content), timed)
+
+def format_links(fmt, content):
+    """Returns the targets of the links in `content`, in the format with
+    extension `fmt`.
+    """
+    try:
+        format = formatter.for_extension(fmt)
+    except KeyError:
+        return [] # shown as plain text, so it has no links
+    return format.links(content)
+
+def format_plain(content):
+    """Shows `content` as preformatted text."""
+    return "<code><pre>{}</pre></code>".format(escape(content))
+
+class RenderFailed (Exception):
+    """Raised when a page couldn't be rendered in time.
+
+    `html` holds a plain-text rendering to show instead, which shouldn't be
+    cached, as the page may well render next time.
+    """
+    def __init__(self, message, html):
+        Exception.__init__(self, message)
+        self.html = html
+
+class RenderPool (object):
+    """Renders pages in worker processes, so rendering uses every core rather
+    than queueing for the GIL, and a page that takes too long can be
+    abandoned.
+
+    Each worker renders one page at a time, so when a page times out only
+    the worker stuck on it is stopped; pages other workers are rendering
+    carry on. Workers are started as they're needed.
+
+    Only formats marked `cpu_bound` go to the pool; the rest are cheaper to
+    render here. Has the same `format(page)` method as this module, so it can
+    be given to `RenderCache` in its place.
+
+    @param processes Number of processes; defaults to the number of CPUs.
+    @param timeout Seconds to wait for a worker to render a page before
+    giving up on it.
+    @param max_size Pages with more characters than this are shown as plain
+    text rather than being rendered.
+    """
+
+    def __init__(self, processes=None, timeout=10, max_size=1024*1024):
+        self.processes = processes or cpu_count()
+        self.timeout = timeout
+        self.max_size = max_size
+        self._workers = set()
+        self._idle = []
+        self._slots = Semaphore(self.processes)
+        self._lock = Lock()
+
+    def format(self, page, timed=False):
+        """Converts a giki page object into HTML.
+
+        @param timed As for `format_text`; the times of pages rendered in
+        the pool are passed back to this process.
+        @raise RenderFailed if the page doesn't render within `timeout`, or
+        its worker dies.
+        """
+        if len(page.content) > self.max_size:
+            return format_plain(page.content)
+        try:
+            cpu_bound = formatter.for_extension(page.fmt).cpu_bound
+        except KeyError:
+            cpu_bound = False
+        if not cpu_bound:
+            return format_text(page.fmt, page.content, timed)
+
+        try:
+            if not timed:
+                return self._apply(format_text, (page.fmt, page.content))
+            html, stages = self._apply(_format_timed,
+                    (page.fmt, page.content))
+        except TimeoutError:
+            raise RenderFailed('Rendering {} timed out'.format(page.fmt),
+                    format_plain(page.content))
+        except (EOFError, IOError):
+            raise RenderFailed('Rendering {} failed'.format(page.fmt),
+                    format_plain(page.content))
+        timings = stats.current()
+        if timings is not None:
+            for (name, label), (seconds, calls) in stages.items():
+                timings.add(name, seconds, label)
+        return html
+
+    def close(self):
+        """Stops the worker processes, including any still rendering."""
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+            del self._idle[:]
+        for worker in workers:
+            worker.stop()
+
+    def _apply(self, func, args):
+        """Calls `func(*args)` in a free worker, waiting for one if they're
+        all busy.
+
+        @raise TimeoutError if the call takes longer than `timeout`; the
+        worker is stopped.
+        """
+        with self._slots:
+            worker = self._checkout()
+            try:
+                worker.conn.send((func, args))
+                if not worker.conn.poll(self.timeout):
+                    raise TimeoutError()
+                ok, value = worker.conn.recv()
+            except:
+                # it's stuck on this page, or gone; the next call starts a
+                # replacement
+                self._discard(worker)
+                raise
+            self._checkin(worker)
+        if not ok:
+            raise value
+        return value
+
+    def _checkout(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+            worker = _Worker()
+            self._workers.add(worker)
+            return worker
+
+    def _checkin(self, worker):
+        with self._lock:
+            if worker in self._workers: # else the pool was closed meanwhile
+                self._idle.append(worker)
+                return
+        worker.stop()
+
+    def _discard(self, worker):
+        with self._lock:
+            self._workers.discard(worker)
+        worker.stop()
+
+class _Worker (object):
+    """A process that renders for a `RenderPool`, one page at a time."""
+
+    def __init__(self):
+        self.conn, child_conn = Pipe()
+        self.process = Process(target=_work, args=(child_conn,))
+        self.process.daemon = True
+        self.process.start()
+        child_conn.close()
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        self.conn.close()
+
+def _work(conn):
+    """Runs in a worker process, calling each function sent down `conn` and
+    sending back (True, result), or (False, exception) if it raised.
+    """
+    while True:
+        try:
+            func, args = conn.recv()
+        except EOFError:
+            return
+        try:
+            result = True, func(*args)
+        except Exception as e:
+            result = False, e
+        conn.send(result)
+
+def _format_timed(fmt, content):
+    """Renders in a pool process, returning the HTML and the stages timed."""
+    stats.start()
+    try:
+        html = format_text(fmt, content, True)
+    finally:
+        timings = stats.stop()
+    return html, dict(timings.stages)
 
 def get_names(page):
+    return format_names(page.fmt)
+
+def format_names(fmt):
+    """Returns a tuple of the human-readable name and CodeMirror mode of the
+    format with extension `fmt`.
+    """
     try:
-        fmt = formatter.for_extension(page.fmt)
-        return fmt.human_name, fmt.codemirror_types[0]
+        format = formatter.for_extension(fmt)
+        modes = format.codemirror_types
+        return format.human_name, modes[0] if modes else None
     except KeyError:
-        return page.fmt, None
+        return fmt, None
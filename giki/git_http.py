@@ -0,0 +1,320 @@
+"""Serves the wiki's repository over git's smart HTTP protocol, so it can be
+cloned from and pushed to at `<wiki url>/+git`.
+"""
+import os
+import zlib
+from hashlib import sha1
+from tempfile import NamedTemporaryFile, SpooledTemporaryFile
+from threading import Lock
+
+from dulwich.protocol import ReceivableProtocol, ZERO_SHA, pkt_line
+from dulwich.repo import Repo
+from dulwich.server import (Backend, UploadPackHandler, ReceivePackHandler,
+        ProtocolGraphWalker)
+from werkzeug.exceptions import BadRequest, Forbidden
+from werkzeug.wrappers import Response
+
+from .web_framework import get, post
+
+class _UploadPackHandler (UploadPackHandler):
+    def handle(self):
+        if self.advertise_refs:
+            # Some versions of dulwich choke when only asked to list the
+            # refs, so do that part here.
+            walker = ProtocolGraphWalker(self, self.repo.object_store,
+                    self.repo.get_peeled)
+            walker.determine_wants(self.repo.get_refs())
+            return
+        UploadPackHandler.handle(self)
+
+class _RefUpdates (object):
+    """Stands in for a repository's refs while dulwich applies a push,
+    noting the updates rather than making them.
+    """
+    def __init__(self):
+        self.updates = {}
+
+    def __setitem__(self, ref, sha):
+        self.updates[ref] = sha
+
+    def __delitem__(self, ref):
+        self.updates[ref] = None
+
+class _ReceivePackHandler (ReceivePackHandler):
+    """Moves refs with compare-and-swap, so a push can't silently undo a
+    change that was saved through the web after the client fetched; the
+    pusher is told to fetch first instead.
+    """
+
+    def _apply_pack(self, refs):
+        real_refs = self.repo.refs
+        self.repo.refs = recorder = _RefUpdates()
+        try:
+            status = ReceivePackHandler._apply_pack(self, refs)
+        finally:
+            self.repo.refs = real_refs
+
+        unpacked = status[0] == ('unpack', 'ok')
+        old_shas = dict((ref, old_sha) for old_sha, sha, ref in refs)
+        result = []
+        for name, message in status:
+            if name != 'unpack' and message == 'ok' and \
+                    name in recorder.updates:
+                if not unpacked:
+                    message = 'unpacker error'
+                elif not self._update_ref(name, old_shas[name],
+                        recorder.updates[name]):
+                    message = 'fetch first'
+            result.append((name, message))
+        return result
+
+    def _update_ref(self, ref, old_sha, new_sha):
+        try:
+            if new_sha is None:
+                return self.repo.refs.remove_if_equals(ref, old_sha)
+            elif old_sha == ZERO_SHA:
+                return self.repo.refs.add_if_new(ref, new_sha)
+            return self.repo.refs.set_if_equals(ref, old_sha, new_sha)
+        except OSError:
+            # someone else holds the ref's lock
+            return False
+
+class _RepoBackend (Backend):
+    """Serves the repository at `path`, whatever path is asked for.
+
+    Each request gets its own `Repo`, so packs being read or written for
+    one don't share open files with any other request, or with the wiki.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def open_repository(self, path):
+        return Repo(self.path)
+
+class GitHTTP (object):
+    """Mixin for `WebWiki` that adds git smart HTTP endpoints under `/+git`.
+
+    Fetching needs 'read' permission, and pushing 'write' permission.
+
+    Responses are written to a temporary file (in memory while they're
+    small) and then streamed out in chunks. Responses to full clones (no
+    'have' lines) depend only on what's asked for and on the refs, so the
+    packs for the last few distinct ones are kept in the repository, and a
+    clone storm only generates each pack once.
+    """
+
+    git_chunk_size = 64 * 1024
+    git_spool_size = 1024 * 1024 # bytes of a response to keep in memory
+    pack_cache_entries = 4 # full clone responses to keep
+
+    _pack_locks = {} # cache key -> [lock, number of requests using it]
+    _pack_locks_lock = Lock()
+
+    services = {
+        'git-upload-pack': ('read', _UploadPackHandler),
+        'git-receive-pack': ('write', _ReceivePackHandler),
+    }
+
+    @get('/+git/info/refs')
+    def git_info_refs(self, request):
+        service = request.args.get('service')
+        if service not in self.services:
+            # dumb clients would need the repository's files served as-is
+            raise Forbidden('Only the smart HTTP protocol is supported.')
+        permission, handler_class = self.services[service]
+        self.get_permission(request, permission)
+
+        output = SpooledTemporaryFile(self.git_spool_size)
+        output.write(pkt_line(b'# service=' + service.encode('ascii') +
+            b'\n'))
+        output.write(pkt_line(None))
+        self.offload(self._run_git, handler_class, request, None, output,
+                advertise_refs=True)
+        return self._git_response(output,
+                'application/x-{}-advertisement'.format(service))
+
+    @post('/+git/git-upload-pack')
+    def git_upload_pack(self, request):
+        self.get_permission(request, 'read')
+        body = self._git_body(request)
+        output = self.offload(self._upload_pack, request, body)
+        return self._git_response(output,
+                'application/x-git-upload-pack-result')
+
+    @post('/+git/git-receive-pack')
+    def git_receive_pack(self, request):
+        self.get_permission(request, 'write')
+        body = self._git_body(request)
+        output = SpooledTemporaryFile(self.git_spool_size)
+        self.offload(self._receive_pack, request, body, output)
+        return self._git_response(output,
+                'application/x-git-receive-pack-result')
+
+    def _upload_pack(self, request, body):
+        """Returns an open file containing the response to an upload-pack
+        request.
+        """
+        key = self._pack_cache_key(body)
+        if key is None:
+            output = SpooledTemporaryFile(self.git_spool_size)
+            self._run_git(_UploadPackHandler, request, body, output)
+            return output
+        return self._cached_pack(key, request, body)
+
+    def _receive_pack(self, request, body, output):
+        self._run_git(_ReceivePackHandler, request, body, output)
+        # let anything listening to the branch know straight away
+        self.wiki._resolve_ref(self.wiki._ref)
+
+    def _run_git(self, handler_class, request, body, output,
+            advertise_refs=False):
+        read = body.read if body is not None else None
+        proto = ReceivableProtocol(read, output.write)
+        handler = handler_class(_RepoBackend(self.wiki._repo.path), ['/'],
+                proto, http_req=request, advertise_refs=advertise_refs)
+        handler.handle()
+
+    def _git_body(self, request):
+        """Returns the request body as a file, spooled to disk if large."""
+        environ = request.environ
+        if 'chunked' not in environ.get('HTTP_TRANSFER_ENCODING', ''):
+            stream = request.stream
+            chunks = iter(lambda: stream.read(self.git_chunk_size), b'')
+        elif environ.get('wsgi.input_terminated'):
+            # the server has de-chunked it, and ends the input with the body
+            stream = environ['wsgi.input']
+            chunks = iter(lambda: stream.read(self.git_chunk_size), b'')
+        else:
+            # git sends bodies bigger than its http.postBuffer chunked, and
+            # servers such as werkzeug's pass them on as they came
+            chunks = _dechunk(environ['wsgi.input'], self.git_chunk_size)
+        body = SpooledTemporaryFile(self.git_spool_size)
+        decompress = None
+        if request.headers.get('Content-Encoding') == 'gzip':
+            # git sends large fetch requests compressed
+            decompress = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress
+        for chunk in chunks:
+            body.write(decompress(chunk) if decompress else chunk)
+        body.seek(0)
+        return body
+
+    def _git_response(self, output, mimetype):
+        length = output.tell()
+        output.seek(0)
+        return Response(_file_chunks(output, self.git_chunk_size),
+                mimetype=mimetype, direct_passthrough=True, headers={
+                    'Content-Length': str(length),
+                    'Cache-Control': 'no-cache',
+                })
+
+    def _pack_cache_key(self, body):
+        """Returns the cache key for an upload-pack request, or None if its
+        response shouldn't be cached.
+        """
+        data = body.read(self.git_spool_size)
+        body.seek(0)
+        if len(data) == self.git_spool_size:
+            return None # too much going on to be a plain clone
+        for word in (b'have ', b'shallow ', b'deepen'):
+            if word in data:
+                return None
+        # the wanted objects are immutable, but which tags are included
+        # depends on the refs
+        refs = sorted(self.wiki._repo.refs.as_dict().items())
+        return sha1(data + repr(refs)).hexdigest()
+
+    def _cached_pack(self, key, request, body):
+        """Returns an open file containing the response to a full clone,
+        generating it if it isn't in the cache.
+        """
+        directory = self.wiki._data_path('pack-cache')
+        path = os.path.join(directory, key)
+
+        # only generate each pack once in this process; the lock is shared
+        # by the requests waiting for the pack, and dropped after the last
+        with self._pack_locks_lock:
+            entry = self._pack_locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                return self._open_cached_pack(path, request, body)
+        finally:
+            with self._pack_locks_lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._pack_locks[key]
+
+    def _open_cached_pack(self, path, request, body):
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            pass
+        else:
+            os.utime(path, None) # keep it from being pruned
+            f.seek(0, os.SEEK_END)
+            return f
+
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        f = NamedTemporaryFile(dir=directory, delete=False)
+        try:
+            self._run_git(_UploadPackHandler, request, body, f)
+        except:
+            f.close()
+            os.remove(f.name)
+            raise
+        f.flush()
+        os.rename(f.name, path)
+        self._prune_pack_cache(directory)
+        return f
+
+    def _prune_pack_cache(self, directory):
+        entries = []
+        for name in os.listdir(directory):
+            if len(name) != 40:
+                continue # a pack still being written
+            try:
+                entries.append((os.path.getmtime(
+                    os.path.join(directory, name)), name))
+            except OSError:
+                pass
+        entries.sort()
+        for mtime, name in entries[:-self.pack_cache_entries]:
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+def _file_chunks(f, size):
+    try:
+        while True:
+            chunk = f.read(size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        f.close()
+
+def _dechunk(stream, size):
+    """Yields the data of a request body sent with `Transfer-Encoding:
+    chunked`, read from `stream`, in pieces of up to `size` bytes.
+    """
+    while True:
+        line = stream.readline(1024)
+        try:
+            length = int(line.split(b';', 1)[0], 16)
+        except ValueError:
+            raise BadRequest('Bad chunk size')
+        if not length:
+            break
+        while length:
+            data = stream.read(min(length, size))
+            if not data:
+                raise BadRequest('Body ended in a chunk')
+            length -= len(data)
+            yield data
+        stream.readline(1024) # the CRLF after the chunk
+    # skip any trailers, up to the blank line that ends the body
+    while stream.readline(1024).strip():
+        pass
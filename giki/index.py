@@ -0,0 +1,171 @@
+"""Indexes over a wiki's pages that are kept up to date incrementally.
+
+Each index remembers the commit it was last brought up to date with. When the
+branch moves, only the files that differ between that commit's tree and the
+new one are re-indexed; identical subtrees are skipped by comparing their
+SHAs, so the cost of an update depends on the size of the change rather than
+the size of the wiki.
+"""
+from __future__ import unicode_literals
+import os
+import cPickle as pickle
+from tempfile import NamedTemporaryFile
+from threading import Condition, RLock, Thread
+from time import time
+from traceback import print_exc
+
+from dulwich.diff_tree import tree_changes
+
+def split_filename(filename):
+    """Splits a file path from the tree into the page path and format, eg
+    `foo/bar.mdown` into (`foo/bar`, `mdown`).
+
+    @return None if the file can't be a page.
+    """
+    directory, _, name = filename.rpartition('/')
+    parts = name.split('.')
+    if len(parts) < 2:
+        return None
+    return '/'.join(filter(None, (directory, parts[0]))), parts[1]
+
+class TreeIndex (object):
+    """Base class for indexes over the files in the wiki's branch.
+
+    Subclasses set `name`, and implement `_reset`, `_add` and `_remove` to
+    maintain their own state; everything stored on the instance apart from
+    `wiki` and `path` is persisted.
+
+    @param wiki The `Wiki` to index.
+    @param path File to store the index in. Defaults to a file named after the
+    index in the repository's control directory.
+    """
+
+    name = None
+    version = 1 # bump this to discard indexes saved in an old format
+    save_interval = 60 # seconds to wait between writing updates to disk
+
+    def __init__(self, wiki, path=None):
+        self.wiki = wiki
+        self.path = path if path is not None else wiki._data_path(self.name)
+        self.commit_id = None
+        self._loaded = False
+        self._last_saved = 0
+        self._lock = RLock()
+        self._moved = False
+        self._condition = Condition()
+
+    def update(self):
+        """Brings the index up to date with the head of the wiki's branch.
+
+        This is cheap if the branch hasn't moved, so call it before every
+        query.
+        """
+        head = self.wiki._resolve_ref(self.wiki._ref)
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            if head == self.commit_id:
+                return
+            self._update_to(head)
+            self.commit_id = head
+            if time() - self._last_saved >= self.save_interval:
+                self.save()
+
+    def start(self):
+        """Starts keeping the index up to date in a background thread,
+        updating it now and each time the wiki's branch moves, so queries
+        rarely have to wait for an update.
+        """
+        self._moved = True
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+        self.wiki.add_ref_listener(self._ref_moved)
+
+    def _ref_moved(self, old_id, new_id):
+        with self._condition:
+            self._moved = True
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._moved:
+                    self._condition.wait()
+                self._moved = False
+            try:
+                self.update()
+            except Exception:
+                print_exc()
+
+    def _update_to(self, head):
+        """Applies the changes between `commit_id` and `head`."""
+        try:
+            old_tree = self.wiki._get_object(self.commit_id).tree \
+                    if self.commit_id is not None else None
+        except KeyError:
+            # our commit has gone away (eg the branch was rewritten and
+            # garbage collected), so start again
+            self._reset()
+            old_tree = None
+        new_tree = self.wiki._get_object(head).tree
+
+        for change in tree_changes(self.wiki._repo.object_store, old_tree,
+                new_tree):
+            if change.old.path is not None:
+                self._remove(change.old.path.decode(self.wiki._encoding),
+                        change.old.sha)
+            if change.new.path is not None:
+                self._add(change.new.path.decode(self.wiki._encoding),
+                        change.new.sha)
+
+    def _reset(self):
+        """Clears the index's state."""
+        raise NotImplementedError()
+
+    def _add(self, filename, blob_id):
+        """Called for each file added to the tree, with its full path."""
+        raise NotImplementedError()
+
+    def _remove(self, filename, blob_id):
+        """Called for each file removed from the tree."""
+        raise NotImplementedError()
+
+    def _read_blob(self, blob_id):
+        return self.wiki._repo.object_store[blob_id].as_raw_string().decode(
+                self.wiki._encoding, 'replace')
+
+    def _state(self):
+        return dict((k, v) for k, v in self.__dict__.items()
+                if k not in ('wiki', 'path', '_loaded', '_last_saved',
+                    '_lock', '_moved', '_condition'))
+
+    def _load(self):
+        self._reset()
+        self.commit_id = None
+        try:
+            with open(self.path, 'rb') as f:
+                version, state = pickle.load(f)
+        except (IOError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+        else:
+            if version == self.version:
+                self.__dict__.update(state)
+        self._loaded = True
+
+    def save(self):
+        """Writes the index to disk."""
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            # write to a temporary file and rename it into place, so other
+            # processes never see a partial index
+            f = NamedTemporaryFile(dir=directory, delete=False)
+            try:
+                pickle.dump((self.version, self._state()), f,
+                        pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            os.rename(f.name, self.path)
+            self._last_saved = time()
@@ -0,0 +1,84 @@
+"""When each file in a wiki was last changed."""
+from __future__ import unicode_literals
+
+from dulwich.diff_tree import tree_changes
+
+from .index import TreeIndex
+
+class LastModifiedIndex (TreeIndex):
+    """Records the last commit to change each file on the branch.
+
+    Rather than diffing two trees, updates walk the branch's first-parent
+    line back from the new head to the last commit seen, and replay each of
+    those commits' changes in order, so only new commits are ever looked at.
+    The walk also stops at a merge with the last commit seen as any of its
+    parents. Changes brought in by a merge are credited to the merge commit,
+    as in `git log --first-parent`.
+    """
+
+    name = 'last-modified'
+
+    def _reset(self):
+        self._modified = {} # file path -> (commit time, commit id, author)
+
+    def _update_to(self, head):
+        chain = [] # (commit id, id of the parent to diff against)
+        id = head
+        while id is not None and id != self.commit_id:
+            parents = self.wiki._get_object(id).parents
+            if self.commit_id in parents:
+                # a merge of our commit, as saves that race make; diff
+                # against it rather than walking the other side
+                chain.append((id, self.commit_id))
+                id = self.commit_id
+                break
+            chain.append((id, parents[0] if parents else None))
+            id = parents[0] if parents else None
+        if id is None and self.commit_id is not None:
+            # our commit isn't behind the new head (eg the branch was
+            # rewritten), so replay the whole branch
+            self._reset()
+
+        store = self.wiki._repo.object_store
+        for id, parent in reversed(chain):
+            commit = self.wiki._get_object(id)
+            parent_tree = self.wiki._get_object(parent).tree \
+                    if parent is not None else None
+            info = (commit.commit_time, commit.id,
+                    commit.author.decode(self.wiki._encoding, 'replace'))
+            for change in tree_changes(store, parent_tree, commit.tree):
+                if change.old.path is not None:
+                    self._modified.pop(change.old.path.decode(
+                        self.wiki._encoding), None)
+                if change.new.path is not None:
+                    self._modified[change.new.path.decode(
+                        self.wiki._encoding)] = info
+
+    def lookup(self, filenames):
+        """Finds when each of `filenames` was last changed.
+
+        @return a dict mapping each file path to a tuple in the form
+        (commit_time, commit_id, author), or to None for files that aren't
+        on the branch.
+        """
+        self.update()
+        with self._lock:
+            return dict((filename, self._modified.get(filename))
+                    for filename in filenames)
+
+    def lookup_at(self, filenames, commit_id):
+        """Like `lookup`, but never waits for the index to be brought up to
+        date, for use where the answer is optional; see `start`.
+
+        @return the dict `lookup` returns if the index is at `commit_id`,
+        otherwise None.
+        """
+        if not self._lock.acquire(False):
+            return None # it's being updated
+        try:
+            if not self._loaded or self.commit_id != commit_id:
+                return None
+            return dict((filename, self._modified.get(filename))
+                    for filename in filenames)
+        finally:
+            self._lock.release()
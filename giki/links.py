@@ -0,0 +1,130 @@
+"""The graph of links between a wiki's pages."""
+from __future__ import unicode_literals
+from urllib import unquote
+from urlparse import urljoin, urlsplit
+
+from .formatter import format_links
+from .index import TreeIndex, split_filename
+
+class LinkIndex (TreeIndex):
+    """Which pages link to which.
+
+    Links are read from each page's markup, without rendering it (see
+    `format_links`). Each blob's links are read once, when it first becomes
+    the content of a page, and kept until no page has it any more; moving
+    or copying a page doesn't read it again.
+
+    Where a page has files in several formats, only the one the wiki shows
+    (the first in the tree) counts.
+    """
+
+    name = 'links'
+    version = 2 # bump this when `format_links` changes
+
+    def _reset(self):
+        self._files = {} # page path -> {file path: blob id}
+        self._blob_links = {} # blob id -> link targets, as written
+        self._blob_pages = {} # blob id -> number of pages showing it
+        self._backlinks = {} # page path -> set of page paths linking to it
+
+    def _add(self, filename, blob_id):
+        page = split_filename(filename)
+        if page is None:
+            return
+        files = self._files.setdefault(page[0], {})
+        old = _shown(files)
+        files[filename] = blob_id
+        self._switch(page[0], old, _shown(files))
+
+    def _remove(self, filename, blob_id):
+        page = split_filename(filename)
+        files = self._files.get(page[0]) if page is not None else None
+        if files is None or filename not in files:
+            return
+        old = _shown(files)
+        del files[filename]
+        if not files:
+            del self._files[page[0]]
+        self._switch(page[0], old, _shown(files))
+
+    def _switch(self, path, old, new):
+        """Replaces the links from the page at `path`, when the file shown
+        for it changes from `old` to `new`: (filename, blob_id) tuples, or
+        None.
+        """
+        if old == new:
+            return
+        if old is not None:
+            blob_id = old[1]
+            for target in self._targets(path, blob_id):
+                sources = self._backlinks[target]
+                sources.discard(path)
+                if not sources:
+                    del self._backlinks[target]
+            self._blob_pages[blob_id] -= 1
+            if not self._blob_pages[blob_id]:
+                del self._blob_pages[blob_id]
+                del self._blob_links[blob_id]
+        if new is not None:
+            filename, blob_id = new
+            if blob_id not in self._blob_links:
+                self._blob_links[blob_id] = tuple(set(format_links(
+                    split_filename(filename)[1], self._read_blob(blob_id))))
+            self._blob_pages[blob_id] = self._blob_pages.get(blob_id, 0) + 1
+            for target in self._targets(path, blob_id):
+                self._backlinks.setdefault(target, set()).add(path)
+
+    def _targets(self, path, blob_id):
+        """Returns the set of pages the page at `path`, with the content of
+        `blob_id`, links to, apart from itself.
+        """
+        targets = set()
+        for href in self._blob_links[blob_id]:
+            target = _link_target(path, href, self.wiki.default_page)
+            if target is not None and target != path:
+                targets.add(target)
+        return targets
+
+    def backlinks(self, path):
+        """Returns a sorted list of the pages that link to the page at
+        `path`.
+        """
+        self.update()
+        with self._lock:
+            return sorted(self._backlinks.get(path, ()))
+
+    def orphans(self):
+        """Returns a sorted list of the pages that no other page links to,
+        apart from the default page.
+        """
+        self.update()
+        with self._lock:
+            return sorted(path for path in self._files
+                    if path not in self._backlinks and
+                    path != self.wiki.default_page)
+
+def _shown(files):
+    """Returns (filename, blob_id) for the file shown for a page, given a
+    dict of its files; as in `Wiki._get_manifest`, the first in the tree
+    wins.
+    """
+    if not files:
+        return None
+    filename = min(files)
+    return filename, files[filename]
+
+def _link_target(path, href, default_page):
+    """Returns the path of the page that `href`, on the page at `path`,
+    links to, or None if it doesn't link to a page of the wiki.
+    """
+    scheme, netloc, target, query, fragment = urlsplit(urljoin('/' + path,
+        href))
+    if scheme or netloc:
+        return None
+    target = unquote(target.encode('utf-8')).decode('utf-8', 'replace')
+    target = target.strip('/')
+    if not target:
+        return default_page # the home page redirects there
+    if target.startswith('+'):
+        return None # history, search and so on
+    return target
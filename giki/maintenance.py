@@ -0,0 +1,146 @@
+"""Keeps the wiki's repository in shape while it's being served.
+
+Every save writes its blob, each tree above it and its commit as separate
+loose object files. Left alone, a busy wiki ends up with hundreds of
+thousands of them, which makes reads and clones slow.
+"""
+from __future__ import unicode_literals
+import fcntl
+import os
+from threading import Thread
+from time import sleep
+from traceback import print_exc
+
+from dulwich.objects import ShaFile
+from dulwich.repo import Repo
+
+class Maintainer (object):
+    """Moves loose objects into packs.
+
+    Objects are packed `batch_size` at a time, each batch into a new pack
+    with its index, so memory use stays bounded however many there are. A
+    loose object is only removed once the pack holding it is in place, so
+    readers always find it one way or the other.
+
+    Only one maintainer works on a repository at a time, even across
+    processes; any others skip their turn.
+
+    @param wiki The `Wiki` whose repository to maintain.
+    @param loose_threshold Number of loose objects to allow before packing.
+    @param batch_size Most objects to put in one pack.
+    @param interval Seconds between checks, when run in the background.
+    """
+
+    def __init__(self, wiki, loose_threshold=1000, batch_size=10000,
+            interval=10 * 60):
+        self.wiki = wiki
+        self.loose_threshold = loose_threshold
+        self.batch_size = batch_size
+        self.interval = interval
+        self._thread = None
+
+    def start(self):
+        """Starts checking the repository every `interval` seconds in a
+        background thread.
+        """
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.maintain()
+            except Exception:
+                print_exc()
+            sleep(self.interval)
+
+    def estimate_loose(self, store):
+        """Estimates the number of loose objects in `store`.
+
+        As with `git gc --auto`, only one of the 256 directories they're
+        spread across is counted, so this is cheap however many there are.
+        """
+        try:
+            names = os.listdir(os.path.join(store.path, '17'))
+        except OSError:
+            return 0
+        return 256 * sum(1 for name in names if len(name) == 38)
+
+    def maintain(self, force=False):
+        """Packs the repository's loose objects, if there are more than
+        `loose_threshold` of them.
+
+        @param force Whether to pack them however few there are.
+        @return the number of objects packed, or None if another maintainer
+        is already at work.
+        """
+        lock = self._lock()
+        if lock is None:
+            return None
+        try:
+            # our own Repo, so the wiki's packs aren't touched from here
+            store = Repo(self.wiki._repo.path).object_store
+            if not force and \
+                    self.estimate_loose(store) < self.loose_threshold:
+                return 0
+
+            count = 0
+            batch = []
+            for sha, path in _loose_objects(store):
+                batch.append((sha, path))
+                if len(batch) == self.batch_size:
+                    count += self._pack(store, batch)
+                    batch = []
+            if batch:
+                count += self._pack(store, batch)
+            return count
+        finally:
+            lock.close()
+
+    def _lock(self):
+        """Returns the open lock file if the lock was taken, else None."""
+        path = self.wiki._data_path('maintain.lock')
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return None
+        return f
+
+    def _pack(self, store, batch):
+        """Writes the loose objects in `batch` to a new pack, then removes
+        them.
+
+        @return the number of objects packed.
+        """
+        objects = []
+        for sha, path in batch:
+            if store.contains_packed(sha):
+                continue # packed by an earlier run that was cut short
+            try:
+                objects.append((ShaFile.from_path(path), None))
+            except (IOError, OSError):
+                pass # removed by something else, eg git gc
+        store.add_objects(objects)
+
+        for sha, path in batch:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(objects)
+
+def _loose_objects(store):
+    """Yields the SHA and path of each loose object in `store`."""
+    for base in sorted(os.listdir(store.path)):
+        if len(base) != 2:
+            continue
+        directory = os.path.join(store.path, base)
+        for rest in os.listdir(directory):
+            # anything else is a file still being written
+            if len(rest) == 38:
+                yield base + rest, os.path.join(directory, rest)
@@ -0,0 +1,87 @@
+"""Line-based three-way merging of page content."""
+from __future__ import unicode_literals
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+class Conflict (namedtuple('Conflict', 'start base ours theirs')):
+    """A region of the base text that both sides changed differently.
+
+    - `start` - the index of the region's first line in the base text.
+    - `base`, `ours`, `theirs` - the region's lines in each version.
+    """
+    __slots__ = ()
+
+def _sync_regions(base, ours, theirs):
+    """Yields (base_start, ours_start, theirs_start, length) for each run of
+    lines that is unchanged on both sides, finishing with an empty run at the
+    end of all three texts.
+    """
+    ours_blocks = SequenceMatcher(None, base, ours,
+            autojunk=False).get_matching_blocks()
+    theirs_blocks = SequenceMatcher(None, base, theirs,
+            autojunk=False).get_matching_blocks()
+
+    i = j = 0
+    while i < len(ours_blocks) and j < len(theirs_blocks):
+        a_base, a_other, a_len = ours_blocks[i]
+        b_base, b_other, b_len = theirs_blocks[j]
+
+        # where do the two blocks overlap in the base text?
+        start = max(a_base, b_base)
+        end = min(a_base + a_len, b_base + b_len)
+        if start < end:
+            yield (start, a_other + (start - a_base),
+                    b_other + (start - b_base), end - start)
+
+        # move on from whichever block finishes first
+        if a_base + a_len < b_base + b_len:
+            i += 1
+        else:
+            j += 1
+
+    yield len(base), len(ours), len(theirs), 0
+
+def merge3(base, ours, theirs,
+        markers=('<<<<<<< yours\n', '=======\n', '>>>>>>> theirs\n')):
+    """Merges the changes from `base` to `ours` and from `base` to `theirs`.
+
+    Regions changed by only one side take that side's version. Regions both
+    sides changed identically are taken once. Anything else is a conflict.
+
+    @return a tuple of the merged text and a list of `Conflict`s. Conflicting
+    regions appear in the merged text between `markers`, with our version
+    first.
+    """
+    base = base.splitlines(True)
+    ours = ours.splitlines(True)
+    theirs = theirs.splitlines(True)
+
+    out = []
+    conflicts = []
+    base_pos = ours_pos = theirs_pos = 0
+    for base_start, ours_start, theirs_start, length in _sync_regions(
+            base, ours, theirs):
+        # the unstable region between the last sync region and this one
+        b = base[base_pos:base_start]
+        o = ours[ours_pos:ours_start]
+        t = theirs[theirs_pos:theirs_start]
+        if o == b or o == t:
+            out.extend(t)
+        elif t == b:
+            out.extend(o)
+        else:
+            conflicts.append(Conflict(base_pos, b, o, t))
+            for lines, marker in ((o, markers[0]), (t, markers[1])):
+                out.append(marker)
+                out.extend(lines)
+                if lines and not lines[-1].endswith('\n'):
+                    out.append('\n')
+            out.append(markers[2])
+
+        # the sync region itself
+        out.extend(base[base_start:base_start + length])
+        base_pos = base_start + length
+        ours_pos = ours_start + length
+        theirs_pos = theirs_start + length
+
+    return ''.join(out), conflicts
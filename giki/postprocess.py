@@ -0,0 +1,334 @@
+"""Post-processing of the HTML produced by the formatters.
+
+HTML is split into a stream of `Token`s, which is passed through each stage
+of a `Pipeline` in turn. Stages are generator functions taking and yielding
+tokens, so each token flows through every stage before the next one is read:
+the page is processed in a single pass, whatever the number of stages.
+"""
+from __future__ import unicode_literals
+import re
+from HTMLParser import HTMLParser
+from threading import Lock
+from time import time
+from urllib import quote
+
+from . import stats
+
+_token_re = re.compile(r'''
+    <!--.*?-->                          # comment
+  | <![^>]*>                            # doctype, CDATA
+  | <\?[^>]*>                           # processing instruction
+  | </?[a-zA-Z][^\s/>]*                 # tag name
+      (?:[^>"']|"[^"]*"|'[^']*')*>      # attributes, which may contain '>'
+''', re.S | re.X)
+_tag_name_re = re.compile(r'</?([a-zA-Z][^\s/>]*)')
+_attr_re = re.compile(r'''([^\s"'>/=]+)
+    (?:\s*=\s*("[^"]*"|'[^']*'|[^\s"'>]+))?''', re.X)
+
+_unescape = HTMLParser().unescape
+
+class Token (object):
+    """A piece of HTML.
+
+    - `kind` - 'text', 'start', 'end' or 'other' (comments, doctypes).
+    - `html` - the token's HTML source.
+    - `name` - the lowercased tag name, for 'start' and 'end' tokens.
+    """
+    __slots__ = ('kind', 'html', 'name', '_attrs')
+
+    def __init__(self, kind, html, name=None):
+        self.kind = kind
+        self.html = html
+        self.name = name
+        self._attrs = None
+
+    @classmethod
+    def start(cls, name, attrs=()):
+        """Creates a start tag token.
+
+        @param attrs List of (name, value) tuples; values are unescaped, or
+        None for attributes without one.
+        """
+        token = cls('start', '', name)
+        token.attrs = list(attrs)
+        return token
+
+    @property
+    def attrs(self):
+        """The start tag's attributes, as a list of (name, value) tuples.
+
+        Modify the list in place, or assign a new one, and then set it back
+        to `attrs` to update `html`.
+        """
+        if self._attrs is None:
+            source = self.html[len(self.name) + 1:-1].rstrip('/')
+            self._attrs = []
+            for name, value in _attr_re.findall(source):
+                if value[:1] in ('"', "'"):
+                    value = value[1:-1]
+                self._attrs.append((name.lower(),
+                    _unescape(value) if value else None))
+        return self._attrs
+
+    @attrs.setter
+    def attrs(self, attrs):
+        self._attrs = attrs
+        parts = [self.name]
+        for name, value in attrs:
+            if value is None:
+                parts.append(name)
+            else:
+                parts.append('{}="{}"'.format(name, escape(value, True)))
+        self.html = '<{}>'.format(' '.join(parts))
+
+    def get(self, attr, default=None):
+        """Returns the value of the start tag's attribute `attr`."""
+        for name, value in self.attrs:
+            if name == attr:
+                return value
+        return default
+
+def escape(text, quote=False):
+    """Escapes `text` for use in HTML, in a single pass."""
+    return text.translate(_quote_escapes if quote else _escapes)
+
+_escapes = {ord('&'): '&amp;', ord('<'): '&lt;', ord('>'): '&gt;'}
+_quote_escapes = dict(_escapes)
+_quote_escapes[ord('"')] = '&quot;'
+
+def tokenize(html):
+    """Yields the `Token`s that make up `html`."""
+    pos = 0
+    for match in _token_re.finditer(html):
+        start = match.start()
+        if start > pos:
+            yield Token('text', html[pos:start])
+        source = match.group()
+        if source[1] == '/':
+            yield Token('end', source,
+                    _tag_name_re.match(source).group(1).lower())
+        elif source[1] in '!?':
+            yield Token('other', source)
+        else:
+            yield Token('start', source,
+                    _tag_name_re.match(source).group(1).lower())
+        pos = match.end()
+    if pos < len(html):
+        yield Token('text', html[pos:])
+
+def links(html):
+    """Returns the targets of the links in `html`, in order."""
+    return [token.get('href') for token in tokenize(html)
+            if token.kind == 'start' and token.name == 'a' and
+            token.get('href')]
+
+class Pipeline (object):
+    """A series of stages that HTML is passed through.
+
+    @param stages Generator functions that take an iterable of `Token`s and
+    yield tokens, in the order to apply them.
+    """
+
+    def __init__(self, stages=()):
+        self.stages = list(stages)
+        self.timings = {} # stage name: [seconds, calls]
+        self._timings_lock = Lock()
+
+    def stage(self, func):
+        """Decorator that adds `func` to the end of the pipeline."""
+        self.stages.append(func)
+        return func
+
+    def process(self, html, timed=False):
+        """Passes `html` through every stage.
+
+        @param timed Whether to add the time spent in each stage to
+        `timings`, and to the `postprocess` stage of the request being
+        timed, if any. This costs a little per token per stage, so it's off
+        by default.
+        """
+        if not timed:
+            tokens = tokenize(html)
+            for stage in self.stages:
+                tokens = stage(tokens)
+            return ''.join(token.html for token in tokens)
+
+        # Time spent pulling from each generator includes the time spent in
+        # the ones before it, so each stage's own time is the difference.
+        clocks = [[0.0]]
+        tokens = _timed(tokenize(html), clocks[0])
+        for stage in self.stages:
+            clocks.append([0.0])
+            tokens = _timed(stage(tokens), clocks[-1])
+        html = ''.join(token.html for token in tokens)
+
+        names = ['tokenize'] + [stage.__name__ for stage in self.stages]
+        request_timings = stats.current()
+        with self._timings_lock:
+            for i, name in enumerate(names):
+                own = clocks[i][0] - (clocks[i - 1][0] if i else 0)
+                timing = self.timings.setdefault(name, [0.0, 0])
+                timing[0] += own
+                timing[1] += 1
+                if request_timings is not None:
+                    request_timings.add('postprocess', own, name)
+        return html
+
+def _timed(tokens, clock):
+    """Passes `tokens` through, adding the time taken to produce them to
+    `clock[0]`.
+    """
+    tokens = iter(tokens)
+    while True:
+        start = time()
+        try:
+            token = next(tokens)
+        except StopIteration:
+            clock[0] += time() - start
+            return
+        clock[0] += time() - start
+        yield token
+
+#####
+# STAGES
+
+def table_class(tokens):
+    """Gives tables Bootstrap's `table` class, unless they have a class."""
+    for token in tokens:
+        if token.kind == 'start' and token.name == 'table' and \
+                token.get('class') is None:
+            token.attrs = token.attrs + [('class', 'table')]
+        yield token
+
+_wiki_link_re = re.compile(r'\[\[([^\]|]+)(?:\|([^\]]+))?\]\]')
+
+def wiki_link_href(target):
+    """Returns the URL that the wiki link `[[target]]` points to."""
+    return '/' + quote(target.strip().lstrip('/').encode('utf-8'),
+            safe=b'/#').decode('ascii')
+
+def raw_wiki_links(text):
+    """Returns the URLs of the `[[page]]` links in the unrendered `text`."""
+    return [wiki_link_href(match.group(1))
+            for match in _wiki_link_re.finditer(text)]
+
+def wiki_links(tokens):
+    """Turns `[[page]]` and `[[page|label]]` in text into links to other
+    pages of the wiki.
+
+    Text inside links, code and preformatted blocks is left alone.
+    """
+    skip = 0
+    for token in tokens:
+        if token.name in ('a', 'code', 'pre'):
+            if token.kind == 'start':
+                skip += 1
+            elif token.kind == 'end' and skip:
+                skip -= 1
+        if skip or token.kind != 'text' or '[[' not in token.html:
+            yield token
+            continue
+
+        text = token.html
+        pos = 0
+        for match in _wiki_link_re.finditer(text):
+            if match.start() > pos:
+                yield Token('text', text[pos:match.start()])
+            href = wiki_link_href(_unescape(match.group(1)))
+            yield Token.start('a', [('href', href), ('class', 'wikilink')])
+            yield Token('text', (match.group(2) or match.group(1)).strip())
+            yield Token('end', '</a>', 'a')
+            pos = match.end()
+        if pos < len(text):
+            yield Token('text', text[pos:])
+
+_headings = ('h1', 'h2', 'h3', 'h4', 'h5', 'h6')
+_slug_re = re.compile(r'[^\w]+', re.U)
+
+def heading_anchors(tokens):
+    """Puts an anchor before each heading, so sections can be linked to.
+
+    The anchor's id is made from the heading's text. Headings that already
+    have an id are left alone.
+    """
+    seen = {}
+    heading = None # the tokens of the heading we're in, if any
+    for token in tokens:
+        if heading is None:
+            if token.kind == 'start' and token.name in _headings and \
+                    token.get('id') is None:
+                heading = [token]
+            else:
+                yield token
+            continue
+
+        heading.append(token)
+        if token.kind == 'end' and token.name == heading[0].name:
+            text = ''.join(t.html for t in heading if t.kind == 'text')
+            slug = _slug_re.sub('-', _unescape(text).lower()).strip('-') \
+                    or 'section'
+            count = seen.get(slug, 0)
+            seen[slug] = count + 1
+            if count:
+                slug = '{}-{}'.format(slug, count)
+            yield Token.start('a', [('class', 'anchor'), ('id', slug)])
+            yield Token('end', '</a>', 'a')
+            for t in heading:
+                yield t
+            heading = None
+    if heading is not None:
+        # unclosed heading
+        for t in heading:
+            yield t
+
+_unsafe_elements = frozenset(('script', 'style', 'iframe', 'frame',
+    'frameset', 'object', 'embed', 'applet', 'base', 'link', 'meta', 'form'))
+# these have no end tag, so have no content to remove
+_void_elements = frozenset(('base', 'link', 'meta', 'embed', 'frame'))
+_url_attrs = frozenset(('href', 'src', 'action', 'formaction', 'background',
+    'poster', 'xlink:href'))
+_unsafe_url_re = re.compile(r'^(?:javascript|vbscript|data):', re.I)
+# browsers ignore these in URLs, even inside the scheme
+_url_ignored_re = re.compile(r'[\x00-\x20\x7f]+')
+
+def sanitize(tokens):
+    """Removes scripts and other active content: unsafe elements (with
+    their content), event handler attributes and script URLs.
+
+    A `<` in text can only be the start of a malformed tag, which browsers
+    may still read as a tag, so it's escaped.
+    """
+    unsafe = None # the unsafe element we're inside, if any
+    depth = 0
+    for token in tokens:
+        if unsafe is not None:
+            if token.name == unsafe:
+                if token.kind == 'start':
+                    depth += 1
+                elif token.kind == 'end':
+                    depth -= 1
+                    if not depth:
+                        unsafe = None
+            continue
+
+        if token.name in _unsafe_elements:
+            if token.kind == 'start' and token.name not in _void_elements \
+                    and not token.html.endswith('/>'):
+                unsafe = token.name
+                depth = 1
+            continue
+
+        if token.kind == 'start':
+            attrs = token.attrs
+            safe = [(name, value) for name, value in attrs
+                    if not name.startswith('on') and not (name in _url_attrs
+                        and value and _unsafe_url(value))]
+            if len(safe) != len(attrs):
+                token.attrs = safe
+        elif token.kind == 'text' and '<' in token.html:
+            token.html = token.html.replace('<', '&lt;')
+        yield token
+
+def _unsafe_url(url):
+    """Returns whether `url`, unescaped, runs a script when followed."""
+    return _unsafe_url_re.match(_url_ignored_re.sub('', url)) is not None
@@ -0,0 +1,99 @@
+"""Renders the pages changed by each update to the wiki's branch ahead of
+time, so the first reader of a changed page finds it in the render cache.
+"""
+from __future__ import unicode_literals
+from threading import Condition, Thread
+from traceback import print_exc
+
+from dulwich.diff_tree import tree_changes
+
+from .index import split_filename
+
+class _Page (object):
+    """Just enough of a `WikiPage` for `RenderCache.render`."""
+    def __init__(self, fmt, content, blob_id):
+        self.fmt = fmt
+        self.content = content
+        self.blob_id = blob_id
+
+class Prerenderer (object):
+    """Renders pages into a `RenderCache` as the branch moves.
+
+    Only the files that differ between the old and new commits' trees are
+    looked at, and subtrees with the same SHA on both sides are skipped
+    without being read.
+
+    @param wiki The `Wiki` whose pages to render.
+    @param render_cache The `RenderCache` to fill.
+    """
+
+    def __init__(self, wiki, render_cache):
+        self.wiki = wiki
+        self.render_cache = render_cache
+        self._pending = None
+        self._condition = Condition()
+        self._thread = None
+
+    def start(self):
+        """Starts rendering in a background thread each time the wiki's
+        branch moves.
+        """
+        self._thread = Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        self.wiki.add_ref_listener(self.ref_moved)
+
+    def ref_moved(self, old_id, new_id):
+        """Queues the changes between two commits to be rendered by the
+        background thread.
+
+        If the thread is busy, moves queue up into one, from the oldest
+        commit to the newest, so pages that have since changed again aren't
+        rendered for nothing.
+        """
+        with self._condition:
+            if self._pending is not None:
+                old_id = self._pending[0]
+            self._pending = (old_id, new_id)
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+                old_id, new_id = self._pending
+                self._pending = None
+            try:
+                self.prerender(old_id, new_id)
+            except Exception:
+                print_exc()
+
+    def prerender(self, old_id, new_id):
+        """Renders the pages changed between the commits `old_id` and
+        `new_id`. With `old_id` as None, every page in `new_id` is rendered.
+
+        @return the number of pages looked at.
+        """
+        store = self.wiki._repo.object_store
+        old_tree = None
+        if old_id is not None:
+            try:
+                old_tree = self.wiki._get_object(old_id).tree
+            except KeyError:
+                pass # eg a new branch; render everything
+        new_tree = self.wiki._get_object(new_id).tree
+
+        count = 0
+        for change in tree_changes(store, old_tree, new_tree):
+            if change.new.path is None or change.new.mode not in (0100644,
+                    0100755):
+                continue
+            page = split_filename(change.new.path.decode(self.wiki._encoding))
+            if page is None:
+                continue
+            content = store[change.new.sha].as_raw_string().decode(
+                    self.wiki._encoding)
+            self.render_cache.render(_Page(page[1], content, change.new.sha))
+            count += 1
+        return count
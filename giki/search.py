@@ -0,0 +1,88 @@
+"""Full-text search over a wiki's pages."""
+from __future__ import unicode_literals
+import re
+from math import log
+
+from .index import TreeIndex, split_filename
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    """Returns the lowercased words in `text`."""
+    return [w.lower() for w in _word_re.findall(text)]
+
+class SearchIndex (TreeIndex):
+    """An inverted index from words to the pages containing them.
+
+    Postings are kept per blob rather than per page, so pages with identical
+    content share them, and moving a page doesn't re-index it.
+    """
+
+    name = 'search'
+
+    def _reset(self):
+        self._postings = {} # word -> {blob id: occurrences}
+        self._blob_files = {} # blob id -> set of file paths
+
+    def _add(self, filename, blob_id):
+        if split_filename(filename) is None:
+            return
+        files = self._blob_files.get(blob_id)
+        if files is not None:
+            files.add(filename)
+            return
+
+        self._blob_files[blob_id] = set([filename])
+        counts = {}
+        for word in tokenize(self._read_blob(blob_id)):
+            counts[word] = counts.get(word, 0) + 1
+        for word, count in counts.items():
+            self._postings.setdefault(word, {})[blob_id] = count
+
+    def _remove(self, filename, blob_id):
+        files = self._blob_files.get(blob_id)
+        if files is None:
+            return
+        files.discard(filename)
+        if files:
+            return
+
+        del self._blob_files[blob_id]
+        for word in set(tokenize(self._read_blob(blob_id))):
+            postings = self._postings.get(word)
+            if postings is not None:
+                postings.pop(blob_id, None)
+                if not postings:
+                    del self._postings[word]
+
+    def search(self, query, limit=50):
+        """Finds the pages containing every word in `query`.
+
+        @return list of page paths, best match first.
+        """
+        self.update()
+        words = set(tokenize(query))
+        if not words:
+            return []
+
+        with self._lock:
+            postings = [self._postings.get(word, {}) for word in words]
+            postings.sort(key=len)
+            # intersect, starting from the rarest word
+            blobs = set(postings[0])
+            for p in postings[1:]:
+                blobs.intersection_update(p)
+            if not blobs:
+                return []
+
+            # rank by tf-idf
+            total = float(len(self._blob_files))
+            weights = [(p, log(total / len(p)) + 1) for p in postings]
+            scores = {}
+            for blob_id in blobs:
+                score = sum(p[blob_id] * weight for p, weight in weights)
+                for filename in self._blob_files[blob_id]:
+                    path = split_filename(filename)[0]
+                    scores[path] = max(score, scores.get(path, 0))
+
+        return sorted(scores, key=lambda path: (-scores[path], path))[:limit]
@@ -0,0 +1,377 @@
+"""A pre-forking, thread-pooled HTTP server for running giki in production.
+
+The master process binds the listening socket and forks worker processes,
+which accept connections from it and hand them to a pool of threads. Each
+worker builds its own app by calling the factory it's given *after* forking,
+so nothing holding open files or locks (like the git repository and its pack
+files) is ever shared between processes.
+
+Signals to the master:
+
+- `SIGHUP` starts a new set of workers, then gracefully stops the old ones.
+- `SIGTERM` or `SIGINT` gracefully stops all workers, then exits.
+
+Workers stop gracefully by finishing the requests they've accepted before
+exiting.
+
+`GeventServer` is a variant whose workers serve each connection from a
+greenlet, so they can hold many idle keep-alive connections open cheaply. It
+needs gevent installed.
+"""
+import errno
+import os
+import select
+import signal
+import socket
+import sys
+from BaseHTTPServer import HTTPServer
+from Queue import Queue
+from threading import Thread
+from time import sleep, time
+from traceback import print_exc
+
+from werkzeug.serving import WSGIRequestHandler, select_ip_version
+
+from . import stats
+
+class KeepAliveRequestHandler (WSGIRequestHandler):
+    """Serves HTTP/1.1, so clients can send several requests over a
+    connection, which is closed after `keep_alive` idle seconds.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        self.timeout = self.server.keep_alive
+        WSGIRequestHandler.setup(self)
+
+    def handle_one_request(self):
+        WSGIRequestHandler.handle_one_request(self)
+        if self.server.stopping:
+            self.close_connection = 1
+
+class ThreadPoolMixIn (object):
+    """Handles requests in a fixed pool of `threads` threads.
+
+    At most `threads` accepted connections wait for a thread; after that the
+    server stops accepting, leaving connections to other workers.
+    """
+    threads = 8
+    _pool = ()
+
+    def start_pool(self):
+        self._requests = Queue(self.threads)
+        self._pool = [Thread(target=self._work) for i in range(self.threads)]
+        for thread in self._pool:
+            thread.daemon = True
+            thread.start()
+
+    def stop_pool(self):
+        """Waits for every accepted connection to be handled, then stops the
+        threads.
+        """
+        for thread in self._pool:
+            self._requests.put(None)
+        for thread in self._pool:
+            thread.join()
+        self._pool = ()
+
+    def process_request(self, request, client_address):
+        self._requests.put((request, client_address))
+
+    def _work(self):
+        while True:
+            item = self._requests.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+class WorkerServer (ThreadPoolMixIn, HTTPServer):
+    """The server run by each worker, on a socket that's already listening.
+
+    This provides the attributes werkzeug's request handler expects of its
+    server.
+    """
+    multithread = True
+    multiprocess = True
+    passthrough_errors = False
+    ssl_context = None
+    shutdown_signal = False
+    poll_interval = 0.5
+
+    def __init__(self, sock, app, threads=8, keep_alive=5):
+        HTTPServer.__init__(self, sock.getsockname()[:2],
+                KeepAliveRequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        self.server_name = self.server_address[0]
+        self.server_port = self.server_address[1]
+        self.app = app
+        self.threads = threads
+        self.keep_alive = keep_alive
+        self.stopping = False
+
+    def serve_until_stopped(self):
+        """Serves requests until `stopping` is set, eg by a signal handler,
+        then waits for the ones in progress to finish.
+        """
+        self.start_pool()
+        try:
+            while not self.stopping:
+                try:
+                    self.handle_request()
+                except (select.error, socket.error) as e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+        finally:
+            self.stop_pool()
+
+    def handle_request(self):
+        # Several workers wait on the same socket, and all of them wake up
+        # for each connection; the socket is non-blocking, so the ones that
+        # lose the race go back to waiting rather than blocking in accept().
+        r, w, x = select.select([self], [], [], self.poll_interval)
+        if r:
+            self._handle_request_noblock()
+
+    def _handle_request_noblock(self):
+        try:
+            request, client_address = self.get_request()
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        request.setblocking(1)
+        if self.verify_request(request, client_address):
+            try:
+                self.process_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+                self.shutdown_request(request)
+
+    def log(self, type, message, *args):
+        sys.stderr.write(message % args)
+
+class Server (object):
+    """Serves a WSGI app from several worker processes.
+
+    @param app_factory Callable taking no arguments that returns the WSGI app.
+    It's called once in each worker, after it has been forked.
+    @param host Address to listen on.
+    @param port Port to listen on; 0 picks a free one.
+    @param workers Number of worker processes. With 0 the app is served from
+    the calling process, which is handy for debugging.
+    @param threads Number of requests each worker handles at once.
+    @param keep_alive Seconds to keep idle connections open for.
+    """
+
+    backlog = 128
+    respawn_delay = 1 # seconds before replacing a worker that died young
+    max_failures = 5 # workers in a row that may fail young before giving up
+
+    def __init__(self, app_factory, host='127.0.0.1', port=8080, workers=2,
+            threads=8, keep_alive=5):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.threads = threads
+        self.keep_alive = keep_alive
+        self.socket = None
+        self._workers = {} # pid: (generation, start time)
+        self._generation = 0
+        self._failures = 0
+        self._running = False
+        self._reload = False
+
+    def bind(self):
+        """Opens the listening socket.
+
+        This is done by `serve_forever` if it hasn't been already.
+
+        @return the address the socket is bound to.
+        """
+        sock = socket.socket(select_ip_version(self.host, self.port),
+                socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(0)
+        self.socket = sock
+        return sock.getsockname()[:2]
+
+    def serve_forever(self):
+        """Serves requests until the master is sent `SIGTERM` or `SIGINT`."""
+        if self.socket is None:
+            self.bind()
+        if not self.workers:
+            return self._run_worker(fork=False)
+
+        self._running = True
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        try:
+            for i in range(self.workers):
+                self._spawn()
+            while self._running:
+                if self._reload:
+                    self._reload = False
+                    self._reload_workers()
+                self._reap()
+        finally:
+            self._stop_workers()
+            self.socket.close()
+
+    def _handle_reload(self, signum, frame):
+        self._reload = True
+
+    def _handle_stop(self, signum, frame):
+        self._running = False
+
+    def _spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            # until the worker sets up its own handlers, signals should just
+            # kill it rather than run the master's handlers
+            for sig in (signal.SIGHUP, signal.SIGTERM):
+                signal.signal(sig, signal.SIG_DFL)
+            status = 0
+            try:
+                self._run_worker(fork=True)
+            except:
+                print_exc()
+                status = 1
+            finally:
+                sys.stderr.flush()
+                os._exit(status)
+        self._workers[pid] = (self._generation, time())
+
+    def _reload_workers(self):
+        """Replaces every worker, starting the new ones before stopping the
+        old ones so there's always someone accepting connections.
+        """
+        old = list(self._workers)
+        self._generation += 1
+        for i in range(self.workers):
+            self._spawn()
+        for pid in old:
+            self._kill(pid, signal.SIGTERM)
+
+    def _reap(self):
+        """Waits for a worker to exit, replacing it if it should still be
+        running.
+        """
+        try:
+            pid, status = os.wait()
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return # a signal arrived; let the main loop see it
+            raise
+        generation, started = self._workers.pop(pid, (None, None))
+        if self._running and generation == self._generation:
+            if time() - started < self.respawn_delay:
+                # probably failing at startup; don't spin
+                if status:
+                    self._failures += 1
+                    if self._failures >= self.max_failures:
+                        raise RuntimeError('Workers keep failing to start')
+                sleep(self.respawn_delay)
+            else:
+                self._failures = 0
+            self._spawn()
+
+    def _stop_workers(self):
+        for pid in list(self._workers):
+            self._kill(pid, signal.SIGTERM)
+        while self._workers:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    break
+                raise
+            self._workers.pop(pid, None)
+
+    def _kill(self, pid, sig):
+        try:
+            os.kill(pid, sig)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _run_worker(self, fork):
+        server = WorkerServer(self.socket, self.app_factory(),
+                threads=self.threads, keep_alive=self.keep_alive)
+
+        def stop(signum, frame):
+            server.stopping = True
+        signal.signal(signal.SIGTERM, stop)
+        if fork:
+            # the master passes these on as SIGTERM when it's ready
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        else:
+            signal.signal(signal.SIGINT, stop)
+
+        server.serve_until_stopped()
+
+class GeventServer (Server):
+    """Like `Server`, but each worker serves connections from gevent
+    greenlets rather than threads.
+
+    Connections cost very little while they are idle, so each worker can
+    keep thousands open. The greenlets all share one thread, so the app's
+    `offload_pool` is set to a pool of `threads` threads, which views pass
+    slow blocking work (reading from git, rendering pages) to.
+
+    Takes the same arguments as `Server`.
+    """
+
+    stop_timeout = 30 # seconds to let requests finish when stopping
+
+    def _run_worker(self, fork):
+        # gevent is only imported by workers, after forking
+        import gevent
+        from gevent.pywsgi import WSGIServer, WSGIHandler
+        from gevent.threadpool import ThreadPool
+        from gevent.local import local
+
+        # requests share the thread, so time each greenlet's separately
+        stats._current = local()
+
+        keep_alive = self.keep_alive
+        class Handler (WSGIHandler):
+            def __init__(self, sock, *args, **kwargs):
+                sock.settimeout(keep_alive)
+                WSGIHandler.__init__(self, sock, *args, **kwargs)
+
+            def get_environ(self):
+                environ = WSGIHandler.get_environ(self)
+                # pywsgi de-chunks request bodies
+                environ['wsgi.input_terminated'] = True
+                return environ
+
+        app = self.app_factory()
+        app.offload_pool = ThreadPool(self.threads)
+        server = WSGIServer(self.socket, app, handler_class=Handler)
+
+        def stop():
+            server.stop(self.stop_timeout)
+        signal_handler = getattr(gevent, 'signal_handler', gevent.signal)
+        signal_handler(signal.SIGTERM, stop)
+        if fork:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        else:
+            signal_handler(signal.SIGINT, stop)
+
+        server.serve_forever()
+        app.offload_pool.kill()
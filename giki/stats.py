@@ -0,0 +1,212 @@
+"""Timing of the stages requests spend their time in.
+
+Code on the hot path wraps each stage in `timer`:
+
+    with timer('ref'):
+        id = refs[name]
+
+While a request is being timed (see `WebApp.stats`), the time is added to
+that request's `Timings`; otherwise `timer` hands back a shared object that
+does nothing, so the hooks cost next to nothing when timing is off.
+"""
+from __future__ import unicode_literals
+import math
+from collections import OrderedDict
+from threading import Lock, local
+from time import time
+
+# the Timings for the request being handled, if it's being timed; servers
+# whose requests share a thread swap this for their own kind of local
+_current = local()
+
+class Timings (object):
+    """The time spent in each stage while handling one request."""
+
+    def __init__(self):
+        self.start = time()
+        self.total = None
+        self.stages = OrderedDict() # (name, label): [seconds, calls]
+
+    def add(self, name, seconds, label=None):
+        stage = self.stages.get((name, label))
+        if stage is None:
+            self.stages[(name, label)] = [seconds, 1]
+        else:
+            stage[0] += seconds
+            stage[1] += 1
+
+    def finish(self):
+        self.total = time() - self.start
+
+    def header(self):
+        """Returns the timings as the value of a `Server-Timing` header."""
+        parts = []
+        for (name, label), (seconds, calls) in self.stages.items():
+            if label is not None:
+                name = '{};desc="{}"'.format(name,
+                        label.replace('\\', '\\\\').replace('"', '\\"'))
+            parts.append('{};dur={:.3f}'.format(name, seconds * 1000))
+        if self.total is not None:
+            parts.append('total;dur={:.3f}'.format(self.total * 1000))
+        return ', '.join(parts)
+
+class _Timer (object):
+    __slots__ = ('timings', 'name', 'label', 'start')
+
+    def __init__(self, timings, name, label):
+        self.timings = timings
+        self.name = name
+        self.label = label
+
+    def __enter__(self):
+        self.start = time()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.add(self.name, time() - self.start, self.label)
+
+class _NullTimer (object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_timer = _NullTimer()
+
+def timer(name, label=None):
+    """Returns a context manager that adds the time spent in it to stage
+    `name` of the current request, if it's being timed.
+
+    @param label Further detail, eg the format of the page being rendered;
+    stages are timed separately for each label.
+    """
+    timings = getattr(_current, 'timings', None)
+    if timings is None:
+        return _null_timer
+    return _Timer(timings, name, label)
+
+def current():
+    """Returns the `Timings` of the request being handled, or None if it
+    isn't being timed.
+    """
+    return getattr(_current, 'timings', None)
+
+def start():
+    """Starts timing a request on this thread, returning its `Timings`."""
+    timings = _current.timings = Timings()
+    return timings
+
+def stop():
+    """Stops timing the request on this thread."""
+    timings = _current.timings
+    _current.timings = None
+    timings.finish()
+    return timings
+
+def bind(func, timings):
+    """Returns a function that calls `func`, timing its stages into
+    `timings` whichever thread it's called on.
+    """
+    def bound(*args, **kwargs):
+        old = getattr(_current, 'timings', None)
+        _current.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current.timings = old
+    return bound
+
+class Histogram (object):
+    """Counts durations in buckets that grow by about 19% each (four to
+    every doubling), so percentiles are read to within that, in a few
+    hundred bytes however many durations are added.
+    """
+    resolution = 4 # buckets per doubling
+    smallest = 1e-5 # seconds; anything quicker goes in the first bucket
+
+    def __init__(self):
+        self.buckets = {} # index: count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        if seconds > self.smallest:
+            index = int(math.ceil(math.log(seconds / self.smallest, 2) *
+                self.resolution))
+        else:
+            index = 0
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, percent):
+        """Returns the duration that `percent`% of those added took no
+        longer than, or None if none have been added.
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(percent / 100.0 * self.count)
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                upper = self.smallest * 2 ** (float(index) / self.resolution)
+                return min(upper, self.max)
+
+    def summary(self, percentiles=(50, 95, 99)):
+        """Returns a dict of the count, and the mean, maximum and given
+        percentiles in milliseconds.
+        """
+        summary = {
+            'count': self.count,
+            'mean': round(self.total / self.count * 1000, 3)
+                if self.count else None,
+            'max': round(self.max * 1000, 3),
+        }
+        for percent in percentiles:
+            value = self.percentile(percent)
+            summary['p{}'.format(percent)] = round(value * 1000, 3) \
+                    if value is not None else None
+        return summary
+
+class Stats (object):
+    """Latency histograms for an app's requests: their total time by
+    endpoint, and the time each spent in each stage. Labelled stages are
+    also counted by label, as `<stage>/<label>`, eg `format/mdown`.
+    """
+
+    def __init__(self):
+        self.endpoints = {}
+        self.stages = {}
+        self._lock = Lock()
+
+    def record(self, endpoint, timings):
+        """Adds a finished request's `Timings` to the histograms."""
+        with self._lock:
+            _histogram(self.endpoints, endpoint).add(timings.total)
+            totals = {}
+            for (name, label), (seconds, calls) in timings.stages.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+                if label is not None:
+                    _histogram(self.stages, '{}/{}'.format(name, label)
+                            ).add(seconds)
+            for name, seconds in totals.items():
+                _histogram(self.stages, name).add(seconds)
+
+    def report(self):
+        """Returns a JSON-serialisable summary of the histograms."""
+        with self._lock:
+            return {
+                'endpoints': dict((name, h.summary())
+                    for name, h in self.endpoints.items()),
+                'stages': dict((name, h.summary())
+                    for name, h in self.stages.items()),
+            }
+
+def _histogram(histograms, name):
+    histogram = histograms.get(name)
+    if histogram is None:
+        histogram = histograms[name] = Histogram()
+    return histogram
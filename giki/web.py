@@ -1,6 +1,15 @@
-from .core import PageNotFound
-from .formatter import format, get_names
-from jinja2 import Environment, PackageLoader
+from .core import PageNotFound, MergeConflict
+from .cache import LRUCache, RenderCache
+from .formatter import get_names, format_names, VERSION as FORMATTER_VERSION
+from .search import SearchIndex
+from .lastmodified import LastModifiedIndex
+from .links import LinkIndex
+import json
+import re
+from datetime import datetime
+from itertools import islice
+import os
+from jinja2 import Environment, PackageLoader, FileSystemBytecodeCache
 from StringIO import StringIO
 from traceback import print_exc
 
@@ -9,13 +18,43 @@ from werkzeug.utils import redirect
 from werkzeug.exceptions import NotFound
 
 from .web_framework import WebApp, get, post, bind, template
+from .git_http import GitHTTP
 
-class WebWiki (WebApp):
+_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+class WebWiki (WebApp, GitHTTP):
     debug = False
+    history_page_size = 50
+    compression_cache_size = 16*1024*1024 # bytes of compressed pages to keep
+    template_version = 5 # bump when the templates change, to update ETags
     template_env = Environment(loader=PackageLoader('giki', 'templates'))
 
-    def __init__(self, wiki):
+    def __init__(self, wiki, render_cache=None, template_cache=None):
+        """Sets up the app.
+
+        @param wiki The `Wiki` to serve.
+        @param render_cache `RenderCache` to keep formatted pages in. An
+        in-memory one is created if omitted.
+        @param template_cache Directory to keep compiled templates in, so new
+        processes can skip compiling them.
+        """
         self.wiki = wiki
+        if template_cache is not None:
+            if not os.path.isdir(template_cache):
+                os.makedirs(template_cache)
+            self.template_env = self.template_env.overlay(
+                    bytecode_cache=FileSystemBytecodeCache(template_cache))
+        if render_cache is None:
+            render_cache = RenderCache()
+        self.render_cache = render_cache
+        # Page bodies include the head commit, so their compressed copies
+        # are replaced on every commit; keep them out of the render cache's
+        # disk tier, which never evicts.
+        self.compression_cache = LRUCache(
+                max_size=self.compression_cache_size)
+        self.search_index = SearchIndex(wiki)
+        self.last_modified = LastModifiedIndex(wiki)
+        self.link_index = LinkIndex(wiki)
 
     # Authentication stuff
 
@@ -37,6 +76,17 @@ class WebWiki (WebApp):
             'default_page': self.wiki.default_page,
         }
 
+    def precompile_templates(self, names=None):
+        """Loads templates ahead of time, so no request has to wait for them
+        to compile.
+
+        @param names Templates to load; defaults to all of them.
+        """
+        if names is None:
+            names = self.template_env.list_templates()
+        for name in names:
+            self.template_env.get_template(name)
+
     # Actual application stuff
 
     @get('/')
@@ -49,45 +99,223 @@ class WebWiki (WebApp):
         if request.method == 'GET':
             self.get_permission(request, 'read')
             try:
-                p = self.wiki.get_page(path)
+                p = self.offload(self.wiki.get_page, path)
             except PageNotFound:
                 raise NotFound()
-            fmt_human, fmt_cm = get_names(p)
-
-            # get path components for breadcrumb
-            split_path = path.split('/')
-            path_components = []
-            if path != self.wiki.default_page:
-                for i, cpt in enumerate(split_path):
-                    out_cpt = {
-                    'name': cpt,
-                    'path': '/'.join(split_path[:i])
-                    }
-                    path_components.append(out_cpt)
-
-            attrs = {
-                'page': p,
-                'content': format(p),
-                'fmt_human': fmt_human,
-                'fmt_cm': fmt_cm,
-                'path_components': path_components,
-                'default_page': self.wiki.default_page,
+
+            # The page's form carries the commit it was loaded from, so the
+            # ETag is only weak: a copy from an older commit still works, as
+            # saves merge.
+            etag = self.page_etag(p)
+            # the commit the page was loaded from is the branch head, not the
+            # one that last changed it; rather than wait for the index to
+            # catch up, leave Last-Modified out until it has (see
+            # `TreeIndex.start`)
+            filename = '{}.{}'.format(p.path, p.fmt)
+            modified = self.last_modified.lookup_at([filename], p.commit_id)
+            last = modified[filename] if modified is not None else None
+            last_modified = last[0] if last is not None else None
+            not_modified = self.not_modified(request, etag, last_modified,
+                    weak=True)
+            if not_modified is not None:
+                return not_modified
+            headers = self.cache_headers(etag, last_modified, weak=True)
+            headers['Cache-Control'] = 'no-cache'
+            return self.page_context(p), {
+                'mimetype': 'text/html',
+                'headers': headers,
             }
-            return attrs, {'mimetype': 'text/html'}
         elif request.method == 'POST':
             author = self.get_permission(request, 'write')
-            p = self.wiki.get_page_at_commit(path, request.form['commit_id'])
-            p.content = request.form['content']
-            p.save(author, request.form['commit_msg'])
+            commit_id = request.form['commit_id']
+            content = request.form['content']
+            commit_msg = request.form['commit_msg']
+            def save():
+                p = self.wiki.get_page_at_commit(path, commit_id)
+                p.content = content
+                p.save(author, commit_msg)
+            try:
+                self.offload(save)
+            except MergeConflict as e:
+                # send the editor back to the merged text on top of the
+                # current head, with the conflicts marked
+                p = self.offload(self.wiki.get_page_at_commit, path, e.head)
+                attrs = self.page_context(p)
+                p.content = e.merged[path]
+                attrs['conflicts'] = e.conflicts[path]
+                attrs['editing'] = True
+                return attrs, {'mimetype': 'text/html', 'status': 409}
             return redirect('/' + path)
 
+    def page_etag(self, p):
+        """Returns the entity tag for the rendered page `p`."""
+        return '{}.{}.{}.{}'.format(p.blob_id, p.fmt, FORMATTER_VERSION,
+                self.template_version)
+
+    def page_context(self, p):
+        """Returns the template context for showing the page `p`."""
+        fmt_human, fmt_cm = get_names(p)
+
+        # get path components for breadcrumb
+        split_path = p.path.split('/')
+        path_components = []
+        if p.path != self.wiki.default_page:
+            for i, cpt in enumerate(split_path):
+                out_cpt = {
+                'name': cpt,
+                'path': '/'.join(split_path[:i + 1])
+                }
+                path_components.append(out_cpt)
+
+        # cached pages are cheap; only rendering is worth offloading
+        content = self.render_cache.lookup(p)
+        if content is None:
+            content = self.offload(self.render_cache.render, p)
+
+        return {
+            'page': p,
+            'content': content,
+            'fmt_human': fmt_human,
+            'fmt_cm': fmt_cm,
+            'path_components': path_components,
+            'default_page': self.wiki.default_page,
+        }
+
     def __repr__(self):
         return super(WebWiki, self).__repr__()
 
+    @get('/+history/<path:path>')
+    @template('history.html')
+    def history(self, request, path):
+        self.get_permission(request, 'read')
+        start = request.args.get('start')
+        try:
+            if start:
+                start = start.split(',')
+                if not all(_sha_re.match(id) for id in start):
+                    raise NotFound()
+                p = self.offload(self.wiki.get_page_at_commit, path,
+                        start[0])
+            else:
+                p = self.offload(self.wiki.get_page, path)
+        except (PageNotFound, KeyError):
+            raise NotFound()
+
+        history = p.history(start)
+        commits = []
+        for commit in self.offload(list,
+                islice(history, self.history_page_size)):
+            commits.append({
+                'id': commit.id,
+                'author': commit.author.decode(self.wiki._encoding, 'replace'),
+                'time': datetime.utcfromtimestamp(commit.commit_time),
+                'message': commit.message.decode(self.wiki._encoding,
+                    'replace'),
+            })
+        return {
+            'page': p,
+            'commits': commits,
+            'next': ','.join(history.frontier()),
+        }, {'mimetype': 'text/html'}
+
+    @get('/+index/')
+    def list_pages_root(self, request):
+        return self.list_pages(request, '')
+
+    @get('/+index/<path:path>')
+    @template('listing.html')
+    def list_pages(self, request, path):
+        self.get_permission(request, 'read')
+        path = path.strip('/')
+        commit_id = self.offload(self.wiki._resolve_ref, self.wiki._ref)
+
+        # the listing only changes when the branch does
+        etag = 'index.{}.{}'.format(commit_id, self.template_version)
+        not_modified = self.not_modified(request, etag, weak=True)
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            pages, dirs = self.offload(self.wiki.list_directory, path,
+                    commit_id)
+        except PageNotFound:
+            raise NotFound()
+        prefix = path + '/' if path else ''
+        filenames = dict((name, '{}{}.{}'.format(prefix, name, fmt))
+                for name, (fmt, blob_id) in pages.items())
+        modified = self.offload(self.last_modified.lookup,
+                filenames.values())
+
+        entries = []
+        for name, (fmt, blob_id) in sorted(pages.items()):
+            last = modified[filenames[name]]
+            entries.append({
+                'name': name,
+                'path': prefix + name,
+                'fmt_human': format_names(fmt)[0],
+                'time': datetime.utcfromtimestamp(last[0])
+                    if last is not None else None,
+                'author': last[2] if last is not None else None,
+            })
+
+        split_path = path.split('/') if path else []
+        headers = self.cache_headers(etag, weak=True)
+        headers['Cache-Control'] = 'no-cache'
+        return {
+            'path': path,
+            'path_components': [{'name': cpt,
+                'path': '/'.join(split_path[:i + 1])}
+                for i, cpt in enumerate(split_path)],
+            'dirs': [{'name': name, 'path': prefix + name} for name in dirs],
+            'pages': entries,
+        }, {'mimetype': 'text/html', 'headers': headers}
+
+    @get('/+links/<path:path>')
+    @template('backlinks.html')
+    def backlinks(self, request, path):
+        self.get_permission(request, 'read')
+        try:
+            p = self.offload(self.wiki.get_page, path)
+        except PageNotFound:
+            raise NotFound()
+        return {
+            'page': p,
+            'pages': self.offload(self.link_index.backlinks, path),
+        }, {'mimetype': 'text/html'}
+
+    @get('/+orphans')
+    @template('orphans.html')
+    def orphans(self, request):
+        self.get_permission(request, 'read')
+        return {
+            'pages': self.offload(self.link_index.orphans),
+        }, {'mimetype': 'text/html'}
+
+    @get('/+search')
+    @template('search.html')
+    def search(self, request):
+        self.get_permission(request, 'read')
+        query = request.args.get('q', '')
+        return {
+            'query': query,
+            'results': self.offload(self.search_index.search, query),
+        }, {'mimetype': 'text/html'}
+
+    @get('/+stats')
+    def show_stats(self, request):
+        """Reports how long requests have taken, if they're being timed."""
+        self.get_permission(request, 'read')
+        if self.stats is None:
+            raise NotFound()
+        return Response(json.dumps(self.stats.report(), sort_keys=True),
+                mimetype='application/json',
+                headers={'Cache-Control': 'no-cache'})
+
     @post('/+create')
     def create_page(self, request):
         author = self.get_permission(request, 'write')
-        p = self.wiki.create_page(request.form['path'], 'mdown', author)
+        self.offload(self.wiki.create_page, request.form['path'], 'mdown',
+                author)
         return redirect('/' + request.form['path'])
 
     def handle_not_found(self, request):
@@ -104,8 +332,8 @@ class WebWiki (WebApp):
         return Response(template.render(request=request, traceback=traceback))
 
 class SingleUserWiki (WebWiki):
-    def __init__(self, wiki, author):
-        WebWiki.__init__(self, wiki)
+    def __init__(self, wiki, author, **kwargs):
+        WebWiki.__init__(self, wiki, **kwargs)
         self.author = author
 
     def get_permission(self, request, kind):
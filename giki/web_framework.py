@@ -3,63 +3,301 @@
 Web apps are wholly contained in a class, meaning that multiple instances of the same app can be created in the same process.
 """
 
+import zlib
 from copy import copy
-from inspect import getmembers
+from datetime import datetime
+from hashlib import sha1
 from functools import wraps
 
 from werkzeug.wrappers import Request, Response
+from werkzeug.http import http_date, quote_etag
 from werkzeug.routing import Map, Rule
 from werkzeug.exceptions import HTTPException, NotFound
 
+from . import stats as _stats
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class WebAppMeta (type):
+    """Metaclass for `WebApp`, which builds each app class's URL map once,
+    when the class is defined, so requests never have to.
+    """
+
+    def __init__(cls, name, bases, attrs):
+        super(WebAppMeta, cls).__init__(name, bases, attrs)
+
+        # walk the MRO from the base upwards, so overriding a view (or
+        # replacing it with something else) in a subclass wins
+        views = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if getattr(value, '_is_web_view', False):
+                    views[attr] = value._routing_args
+                else:
+                    views.pop(attr, None)
+
+        rules = []
+        for attr, (args, kwargs) in sorted(views.items()):
+            kwargs = copy(kwargs) # don't mess up other classes
+            kwargs['endpoint'] = attr
+            rules.append(Rule(*args, **kwargs))
+        cls._url_map = Map(rules)
+        cls._url_adapters = {}
+
 class WebApp (object):
-    """Subclass this to create a web app."""
-    __url_map = None
+    """Subclass this to create a web app.
 
-    def __build_url_map(self):
-        """Build the URL routing map.
-        
-        This is called the first time the app recieves a request.
-        """
-        l = []
+    Set `compress` to compress responses for clients that accept it. Give
+    the app a `compression_cache` (anything with `get(key)` and
+    `set(key, value)` methods taking byte strings) to keep the compressed
+    bodies of responses with an ETag, so they are only compressed once.
 
-        for name, view in getmembers(self):
-            if getattr(view, "_is_web_view", False):
-                args, kwargs = view._routing_args
-                kwargs = copy(kwargs) # don't mess up other instances
-                kwargs['endpoint'] = name
-                l.append(Rule(*args, **kwargs))
+    Views should pass slow, blocking work to `offload`. By default it just
+    calls the function, but a server whose requests share a thread (see
+    `giki.server.GeventServer`) sets `offload_pool` to a thread pool, so
+    that work doesn't hold up other requests.
 
-        self.__url_map = Map(l)
+    Give the app a `giki.stats.Stats` as `stats` to time each request: the
+    time spent in each stage is sent back in a `Server-Timing` header, and
+    added to the histograms in `stats`.
+    """
+    __metaclass__ = WebAppMeta
+    max_url_adapters = 64 # distinct hosts to keep bound URL maps for
+    compress = False
+    compress_min_size = 1024 # bytes; smaller bodies aren't worth it
+    compress_chunk_size = 64 * 1024
+    compress_types = ('text/', 'application/json', 'application/javascript',
+            'application/xml')
+    compression_cache = None
+    offload_pool = None
+    stats = None
+
+    def __get_url_adapter(self, request):
+        """Returns the class's URL map bound to the request's host.
+
+        Bound maps are shared between instances and threads; they're only
+        read from once created.
+        """
+        key = (request.host, request.script_root, request.scheme)
+        adapters = self._url_adapters
+        adapter = adapters.get(key)
+        if adapter is None:
+            if len(adapters) >= self.max_url_adapters:
+                # don't let bogus Host headers grow this forever
+                adapters.clear()
+            adapter = self._url_map.bind(request.host,
+                    request.script_root or '/', url_scheme=request.scheme)
+            adapters[key] = adapter
+        return adapter
 
     def __dispatch_request(self, request):
         """Dispatch a single request, and return a Werkzeug response."""
-        if self.__url_map is None:
-            self.__build_url_map()
-
-        adapter = self.__url_map.bind_to_environ(request.environ)
+        adapter = self.__get_url_adapter(request)
         try:
-            endpoint, values = adapter.match()
+            endpoint, values = adapter.match(request.path, request.method)
+            request.endpoint = endpoint
             return getattr(self, endpoint)(request, **values)
         except NotFound as e:
+            request.endpoint = 'handle_not_found'
             return self.handle_not_found(request)
         except HTTPException, e:
-            return e
+            return e.get_response(request.environ)
+
+    def __timed_dispatch_request(self, request):
+        """Dispatches a request, timing it into `stats`."""
+        timings = _stats.start()
+        try:
+            response = self.__dispatch_request(request)
+        finally:
+            _stats.stop()
+        self.stats.record(getattr(request, 'endpoint', None) or 'unmatched',
+                timings)
+        response.headers['Server-Timing'] = timings.header()
+        return response
+
+    def offload(self, func, *args, **kwargs):
+        """Calls `func` with the given arguments in `offload_pool`, if there
+        is one, and returns its result.
+        """
+        if self.offload_pool is None:
+            return func(*args, **kwargs)
+        timings = _stats.current()
+        if timings is not None:
+            func = _stats.bind(func, timings)
+        return self.offload_pool.apply(func, args, kwargs)
+
+    def cache_headers(self, etag=None, last_modified=None, weak=False):
+        """Returns a dict of the validator headers for a response.
+
+        @param etag The response's entity tag, unquoted.
+        @param last_modified Modification time, as a Unix timestamp.
+        @param weak Whether `etag` is a weak validator.
+        """
+        headers = {}
+        if etag is not None:
+            headers['ETag'] = quote_etag(etag, weak)
+        if last_modified is not None:
+            headers['Last-Modified'] = http_date(last_modified)
+        return headers
+
+    def not_modified(self, request, etag=None, last_modified=None,
+            weak=False):
+        """Checks a conditional request against the current validators.
+
+        Call this before doing any expensive work to build a response. Takes
+        the same arguments as `cache_headers`.
+
+        @return a 304 response if the client's copy is up to date, otherwise
+        None.
+        """
+        if request.method not in ('GET', 'HEAD'):
+            return None
+
+        # If-None-Match uses the weak comparison, and takes precedence over
+        # If-Modified-Since when both are sent
+        if etag is not None and 'If-None-Match' in request.headers:
+            unmodified = False
+            # a strong ETag is changed for each encoding the body is sent in
+            # (see `compress_response`), so the client may have any of them
+            tags = [etag] if weak else [etag] + [_coded_etag(etag, encoding)
+                    for encoding in _compressors]
+            for tag in tags:
+                if request.if_none_match.contains_weak(tag):
+                    unmodified = True
+                    etag = tag
+                    break
+        elif last_modified is not None and request.if_modified_since:
+            unmodified = (datetime.utcfromtimestamp(last_modified) <=
+                    request.if_modified_since)
+        else:
+            unmodified = False
+
+        if not unmodified:
+            return None
+        return Response(status=304,
+                headers=self.cache_headers(etag, last_modified, weak))
+
+    def compress_response(self, request, response):
+        """Returns `response` compressed with the best encoding the client
+        accepts, or unchanged if it shouldn't be compressed.
+        """
+        if (response.status_code != 200 or response.direct_passthrough or
+                'Content-Encoding' in response.headers or
+                not response.mimetype.startswith(self.compress_types)):
+            return response
+        length = response.headers.get('Content-Length')
+        if length is not None and int(length) < self.compress_min_size:
+            return response
+
+        accept = request.accept_encodings
+        encoding = accept.best_match([e for e in ('br', 'gzip')
+            if e in _compressors])
+        if encoding is None or not accept[encoding]:
+            return response
+
+        headers = response.headers.copy()
+        headers['Content-Encoding'] = encoding
+        headers.add('Vary', 'Accept-Encoding')
+
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            # a strong ETag identifies the exact bytes, so each encoding
+            # needs its own
+            headers['ETag'] = quote_etag(_coded_etag(etag, encoding))
+        if etag is not None and self.compression_cache is not None:
+            # A strong ETag fully determines the body, so compress it once.
+            # Bodies with the same weak ETag can differ, so those are keyed
+            # on the body itself.
+            if weak:
+                body = b''.join(response.iter_encoded())
+                key = sha1(body + b'\0' + encoding.encode('ascii'))
+            else:
+                body = None
+                key = sha1('{}\0{}'.format(etag, encoding).encode('utf-8'))
+            key = key.hexdigest()
+            compressed = self.compression_cache.get(key)
+            if compressed is None:
+                compressed = b''.join(_compress(encoding,
+                    [body] if body is not None else response.iter_encoded()))
+                self.compression_cache.set(key, compressed)
+            body = compressed
+            headers['Content-Length'] = str(len(body))
+            chunks = _chunks(body, self.compress_chunk_size)
+        else:
+            headers.pop('Content-Length', None)
+            chunks = _compress(encoding, response.iter_encoded(),
+                    self.compress_chunk_size)
+
+        return Response(chunks, status=response.status_code, headers=headers,
+                direct_passthrough=True)
 
     def wsgi_app(self, environ, start_response):
         """The actual WSGI app callable."""
         request = Request(environ)
-        response = self.__dispatch_request(request)
+        if self.stats is None:
+            response = self.__dispatch_request(request)
+        else:
+            response = self.__timed_dispatch_request(request)
+        if self.compress:
+            response = self.compress_response(request, response)
         return response(environ, start_response)
 
     def __call__(self, environ, start_response):
         """This provides a shortcut so an instance of this class can be used as a WSGI app directly."""
         return self.wsgi_app(environ, start_response)
 
-    def serve(self, port=8080):
+    def serve(self, port=8080, host='127.0.0.1'):
         from werkzeug.serving import run_simple
-        run_simple('127.0.0.1', port, self, use_debugger=self.debug, use_reloader=self.debug)
+        run_simple(host, port, self, use_debugger=self.debug, use_reloader=self.debug)
         
     
+#####
+# COMPRESSION
+
+_compressors = {
+    # 16 + MAX_WBITS makes zlib write a gzip header and trailer
+    'gzip': lambda: zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+}
+if brotli is not None:
+    _compressors['br'] = brotli.Compressor
+
+def _coded_etag(etag, encoding):
+    """Returns the strong ETag for a body with `etag`, encoded with
+    `encoding`.
+    """
+    return '{}-{}'.format(etag, encoding)
+
+def _compress(encoding, chunks, min_chunk_size=0):
+    """Compresses an iterable of byte strings, yielding compressed output
+    as it becomes available, at least `min_chunk_size` bytes at a time.
+    """
+    compressor = _compressors[encoding]()
+    if encoding == 'br':
+        compress, finish = compressor.process, compressor.finish
+    else:
+        compress, finish = compressor.compress, compressor.flush
+
+    pending = []
+    pending_size = 0
+    for chunk in chunks:
+        out = compress(chunk)
+        if out:
+            pending.append(out)
+            pending_size += len(out)
+            if pending_size >= min_chunk_size:
+                yield b''.join(pending)
+                pending = []
+                pending_size = 0
+    pending.append(finish())
+    yield b''.join(pending)
+
+def _chunks(body, size):
+    for i in xrange(0, len(body), size):
+        yield body[i:i + size]
+
 #####
 # VIEW DECORATORS
 
@@ -137,5 +375,7 @@ class template (object):
                 merged_ctx = copy(global_ctx)
                 merged_ctx.update(context)
 
-            return Response(that.template_env.get_template(self.path).render(**merged_ctx), **response_kwargs)
+            with _stats.timer('template'):
+                html = that.template_env.get_template(self.path).render(**merged_ctx)
+            return Response(html, **response_kwargs)
         return outer
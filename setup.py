@@ -27,6 +27,12 @@ setup(name='giki',
         'faster_markdown':  [
             'misaka==1.0.2',
         ],
+        'brotli':  [
+            'brotli',
+        ],
+        'gevent':  [
+            'gevent',
+        ],
     },
     entry_points = {
     'console_scripts':
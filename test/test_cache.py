@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+from shutil import rmtree
+from tempfile import mkdtemp
+from giki.cache import LRUCache, RenderCache
+from giki import formatter
+
+class DummyPage (object):
+    def __init__(self, format, content, blob_id):
+        self.fmt = format
+        self.content = content
+        self.blob_id = blob_id
+
+def test_render():
+    c = RenderCache()
+    p = DummyPage('mdown', "# h1\n\nparagraph", 'a' * 40)
+    assert c.render(p) == formatter.format(p)
+
+def test_render_hit():
+    c = RenderCache()
+    p = DummyPage('mdown', "# h1\n\nparagraph", 'a' * 40)
+    c.render(p)
+    # the same blob must come back from the cache, not the formatter
+    p.content = "# something else"
+    assert '<h1>h1</h1>' in c.render(p)
+
+def test_render_disk_tier():
+    path = mkdtemp()
+    try:
+        p = DummyPage('mdown', "# h1\n\nparagraph", 'b' * 40)
+        RenderCache(path=path).render(p)
+        p.content = "# something else"
+        assert '<h1>h1</h1>' in RenderCache(path=path).render(p)
+    finally:
+        rmtree(path)
+
+def test_lru_eviction():
+    c = LRUCache(max_size=100)
+    for i in range(10):
+        c.set(i, b'x' * 30)
+    assert 9 in c
+    assert 0 not in c
+
+class FailingRenderer (object):
+    def format(self, page, timed=False):
+        raise formatter.RenderFailed('too slow', 'plain')
+
+def test_render_failed_not_cached():
+    c = RenderCache(renderer=FailingRenderer())
+    p = DummyPage('mdown', "# h1\n\nparagraph", 'c' * 40)
+    assert c.render(p) == 'plain'
+    assert c.lookup(p) is None
@@ -2,7 +2,10 @@
 from __future__ import unicode_literals
 from . import setups
 from nose import with_setup
-from giki.core import Wiki, PageNotFound, PageExists
+from giki.core import Wiki, PageNotFound, PageExists, ManualMergeRequired, \
+        MergeConflict
+from sys import getrecursionlimit
+from itertools import islice
 
 @with_setup(setups.setup_bare_with_page, setups.teardown_bare)
 def test_read():
@@ -105,6 +108,14 @@ def test_unicode_titles():
     w.create_page('いろはにほへとち/test', 'mdown', setups.EXAMPLE_AUTHOR)
     p = w.get_page('いろはにほへとち/test')
 
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_unicode_page_name():
+    w = Wiki(setups.BARE_REPO_PATH)
+    w.create_page('test/いろはにほへとち', 'rst', setups.EXAMPLE_AUTHOR)
+    p = w.get_page('test/いろはにほへとち')
+    assert p.fmt == 'rst'
+    assert w.get_page('test/test').fmt == 'mdown'
+
 @with_setup(setups.setup_bare_with_page, setups.teardown_bare)
 def test_unicode_text():
     w = Wiki(setups.BARE_REPO_PATH)
@@ -138,5 +149,190 @@ def test_merge_into_tree_with_modifications_to_different_files():
     print p1.content
     assert p1.content == 'test1\n'
 
-# TODO: test that WikiPage.save() fails appropriately when the new commit's
-# parent isn't an ancestor of the current commit (ie someone's rebased)
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_save_does_not_touch_cached_trees():
+    w = Wiki(setups.BARE_REPO_PATH)
+    old_commit_id = w.get_page('test/test').commit_id
+    w.create_page('test/test2', 'mdown', setups.EXAMPLE_AUTHOR)
+    w.get_page('test/test2')
+    try:
+        w.get_page_at_commit('test/test2', old_commit_id)
+    except PageNotFound:
+        pass
+    else:
+        assert False
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_history():
+    w = Wiki(setups.BARE_REPO_PATH)
+    first = w.get_page('index').commit_id
+    p = w.get_page('index')
+    p.content = 'one\n'
+    edit = p.save(setups.EXAMPLE_AUTHOR)
+    # changes elsewhere shouldn't show up
+    p = w.get_page('test/test')
+    p.content = 'two\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    p = w.get_page('index')
+    assert [c.id for c in p.history()] == [edit, first]
+    assert [c.id for c in w.get_page('test/test').history()][1:] == [first]
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_history_resume():
+    w = Wiki(setups.BARE_REPO_PATH)
+    for i in range(5):
+        p = w.get_page('index')
+        p.content = '{}\n'.format(i)
+        p.save(setups.EXAMPLE_AUTHOR)
+    p = w.get_page('index')
+    everything = [c.id for c in p.history()]
+    history = p.history()
+    first_page = [c.id for c in islice(history, 2)]
+    rest = [c.id for c in p.history(history.frontier())]
+    assert len(everything) == 6
+    assert first_page + rest == everything
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_transaction():
+    w = Wiki(setups.BARE_REPO_PATH)
+    with w.transaction(setups.EXAMPLE_AUTHOR, 'bulk') as t:
+        t.put('index', 'New index\n')
+        t.put('new/deep/page', 'Deep', 'rst')
+        t.delete('test/test')
+    head = w._repo.refs['refs/heads/master']
+    assert head == t.commit_id
+    assert w.get_page('index').content == 'New index\n'
+    p = w.get_page('new/deep/page')
+    assert p.content == 'Deep\n'
+    assert p.fmt == 'rst'
+    try:
+        w.get_page('test/test')
+    except PageNotFound:
+        pass
+    else:
+        assert False
+    # the emptied directory should be gone too
+    assert 'test' not in w._repo[w._repo[head].tree]
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_transaction_single_commit():
+    w = Wiki(setups.BARE_REPO_PATH)
+    before = w._repo.refs['refs/heads/master']
+    with w.transaction(setups.EXAMPLE_AUTHOR, 'bulk') as t:
+        for i in range(10):
+            t.put('bulk/page{}'.format(i), 'content', 'mdown')
+    head = w._repo.refs['refs/heads/master']
+    assert w._repo[head].parents == [before]
+    assert w.get_page('bulk/page9').content == 'content\n'
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_transaction_discarded_on_error():
+    w = Wiki(setups.BARE_REPO_PATH)
+    before = w._repo.refs['refs/heads/master']
+    try:
+        with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+            t.put('index', 'New index\n')
+            raise ValueError()
+    except ValueError:
+        pass
+    assert w._repo.refs['refs/heads/master'] == before
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_transaction_merges():
+    w = Wiki(setups.BARE_REPO_PATH)
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('one', 'one', 'mdown')
+        p = w.get_page('index')
+        p.content = 'Changed meanwhile\n'
+        p.save(setups.EXAMPLE_AUTHOR)
+    assert w.get_page('one').content == 'one\n'
+    assert w.get_page('index').content == 'Changed meanwhile\n'
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_merge_edits_to_same_page():
+    w = Wiki(setups.BARE_REPO_PATH)
+    p = w.get_page('index')
+    p.content = 'one\ntwo\nthree\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    p1 = w.get_page('index')
+    p2 = w.get_page('index')
+    p1.content = 'ONE\ntwo\nthree\n'
+    p1.save(setups.EXAMPLE_AUTHOR)
+    p2.content = 'one\ntwo\nTHREE\n'
+    p2.save(setups.EXAMPLE_AUTHOR)
+    assert w.get_page('index').content == 'ONE\ntwo\nTHREE\n'
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_merge_conflict():
+    w = Wiki(setups.BARE_REPO_PATH)
+    p = w.get_page('index')
+    p.content = 'one\ntwo\nthree\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    p1 = w.get_page('index')
+    p2 = w.get_page('index')
+    p1.content = 'one\ntheirs\nthree\n'
+    p1.save(setups.EXAMPLE_AUTHOR)
+    p2.content = 'one\nours\nthree\n'
+    try:
+        p2.save(setups.EXAMPLE_AUTHOR)
+    except MergeConflict as e:
+        conflict, = e.conflicts['index']
+        assert conflict.ours == ['ours\n']
+        assert conflict.theirs == ['theirs\n']
+        assert e.head == w._repo.refs['refs/heads/master']
+    else:
+        assert False
+    assert w.get_page('index').content == 'one\ntheirs\nthree\n'
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_concurrent_ref_update():
+    w = Wiki(setups.BARE_REPO_PATH)
+    other = Wiki(setups.BARE_REPO_PATH)
+    p = w.get_page('index')
+
+    # have another writer move the branch just after we've looked at it
+    resolve_ref = w._resolve_ref
+    def racing_resolve_ref(ref):
+        head = resolve_ref(ref)
+        if other.get_page('test/test').content != 'Other\n':
+            q = other.get_page('test/test')
+            q.content = 'Other\n'
+            q.save(setups.EXAMPLE_AUTHOR)
+        return head
+    w._resolve_ref = racing_resolve_ref
+
+    p.content = 'Ours\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    assert other.get_page('index').content == 'Ours\n'
+    assert other.get_page('test/test').content == 'Other\n'
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_merge_after_rebase():
+    w = Wiki(setups.BARE_REPO_PATH)
+    p = w.get_page('index')
+    # replace the branch with an unrelated commit
+    head = w._repo[w._repo.refs['refs/heads/master']]
+    w._repo.refs['refs/heads/master'] = w._do_commit(head.tree, [],
+            setups.EXAMPLE_AUTHOR, 0, 'Rebased')
+    p.content = 'More Content\n'
+    try:
+        p.save(setups.EXAMPLE_AUTHOR)
+    except ManualMergeRequired:
+        pass
+    else:
+        assert False
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_merge_with_long_history():
+    w = Wiki(setups.BARE_REPO_PATH)
+    p = w.get_page('index')
+    # more commits than the recursion limit would allow us to walk
+    head = w._repo[w._repo.refs['refs/heads/master']]
+    commit_id = head.id
+    for i in range(getrecursionlimit() + 100):
+        commit_id = w._do_commit(head.tree, [commit_id],
+                setups.EXAMPLE_AUTHOR, 0, 'Empty')
+    w._repo.refs['refs/heads/master'] = commit_id
+    p.content = 'More Content\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    assert w.get_page('index').content == 'More Content\n'
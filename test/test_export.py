@@ -0,0 +1,48 @@
+from __future__ import unicode_literals
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+from . import setups
+from nose import with_setup
+from giki.core import Wiki
+from giki.export import Exporter
+
+EXPORT_PATH = '_test_export'
+
+def setup_export():
+    setups.setup_bare_with_page()
+
+def teardown_export():
+    setups.teardown_bare()
+    rmtree(EXPORT_PATH, ignore_errors=True)
+
+def read(*path):
+    with open(os.path.join(EXPORT_PATH, *path)) as f:
+        return f.read()
+
+@with_setup(setup_export, teardown_export)
+def test_export():
+    w = Wiki(setups.BARE_REPO_PATH)
+    rendered, removed = Exporter(w, EXPORT_PATH, processes=2).export()
+    assert rendered == ['index', 'test/test']
+    assert removed == []
+    html = read('test', 'test', 'index.html')
+    assert '<h1>Example</h1>' in html
+    assert 'wiki-edit' not in html
+    assert read('index.html') == read('index', 'index.html')
+
+@with_setup(setup_export, teardown_export)
+def test_export_incremental():
+    w = Wiki(setups.BARE_REPO_PATH)
+    Exporter(w, EXPORT_PATH).export()
+    assert Exporter(w, EXPORT_PATH).export() == ([], [])
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('index', '# Changed\n')
+        t.put('new', '# New\n', 'mdown')
+        t.delete('test/test')
+    rendered, removed = Exporter(w, EXPORT_PATH).export()
+    assert rendered == ['index', 'new']
+    assert removed == ['test/test']
+    assert '<h1>Changed</h1>' in read('index.html')
+    assert not os.path.exists(os.path.join(EXPORT_PATH, 'test'))
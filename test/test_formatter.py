@@ -3,7 +3,13 @@
 These tests are not meant to be comprehensive tests of the external formatting libraries, but rather make sure that our wrapper code doesn't blow up.
 """
 from __future__ import unicode_literals
-from giki.formatter import format, get_names
+from threading import Thread
+from time import sleep
+from nose import with_setup
+from giki.formatter import (format, get_names, formatter, RenderPool,
+        RenderFailed)
+from giki import stats
+from giki.postprocess import Pipeline, table_class
 
 class DummyPage (object):
     def __init__(self, format, content):
@@ -34,7 +40,7 @@ def test_textile():
 
 def test_unknown():
     p = DummyPage('aoeuaoeu', "<>&")
-    assert format(p) == "<code><pre>&lt;&gt;&nbsp;</pre></code>"
+    assert format(p) == "<code><pre>&lt;&gt;&amp;</pre></code>"
 
 def test_names():
     p = DummyPage('mdown', "# h1\n\nparagraph")
@@ -47,3 +53,118 @@ def test_names_unknown():
     f, c = get_names(p)
     assert f == 'aoeuaoeu'
     assert c is None
+
+class Slow (object):
+    """A format that takes as many seconds to render as the page says."""
+    human_name = 'Slow'
+    codemirror_types = ()
+    extensions = ('slowtest',)
+    cpu_bound = True
+
+    @staticmethod
+    def format(string):
+        sleep(float(string))
+        return 'done'
+
+def setup_slow():
+    formatter.type(Slow)
+
+def teardown_slow():
+    formatter.formats.remove(Slow)
+    del formatter.extensions['slowtest']
+
+def test_render_pool():
+    pool = RenderPool(1)
+    try:
+        p = DummyPage('mdown', "# h1\n\nparagraph")
+        assert pool.format(p) == format(p)
+        # stage timings come back from the pool
+        p = DummyPage('rst', "Title\n=====\n\nparagraph")
+        timings = stats.start()
+        try:
+            assert pool.format(p, timed=True) == format(p)
+        finally:
+            stats.stop()
+        assert ('postprocess', 'tokenize') in timings.stages
+    finally:
+        pool.close()
+
+def test_plain():
+    t = format(DummyPage('aoeuaoeu', 'a & b <c>'))
+    assert t == '<code><pre>a &amp; b &lt;c&gt;</pre></code>'
+
+def test_render_pool_max_size():
+    pool = RenderPool(1, max_size=5)
+    p = DummyPage('mdown', "# h1\n\nparagraph")
+    assert pool.format(p) == "<code><pre># h1\n\nparagraph</pre></code>"
+    assert not pool._workers
+
+@with_setup(setup_slow, teardown_slow)
+def test_render_pool_timeout():
+    pool = RenderPool(1, timeout=0.5)
+    try:
+        try:
+            pool.format(DummyPage('slowtest', '60'))
+        except RenderFailed as e:
+            assert e.html == "<code><pre>60</pre></code>"
+        else:
+            assert False, 'expected RenderFailed'
+        # the stuck process is replaced
+        assert pool.format(DummyPage('slowtest', '0')) == 'done'
+    finally:
+        pool.close()
+
+@with_setup(setup_slow, teardown_slow)
+def test_render_pool_timeout_others():
+    pool = RenderPool(2, timeout=1)
+    try:
+        failed = []
+        def render_stuck():
+            try:
+                pool.format(DummyPage('slowtest', '60'))
+            except RenderFailed as e:
+                failed.append(e)
+        stuck = Thread(target=render_stuck)
+        stuck.start()
+        sleep(0.5)
+        # still rendering when the other page times out
+        assert pool.format(DummyPage('slowtest', '0.8')) == 'done'
+        stuck.join()
+        assert len(failed) == 1
+        assert len(pool._workers) == 1
+    finally:
+        pool.close()
+
+def test_table_class():
+    t = format(DummyPage('html', '<table><tr><td>a</td></tr></table>'))
+    assert '<table class="table">' in t
+    t = format(DummyPage('html', '<table class="mine"></table>'))
+    assert t == '<table class="mine"></table>'
+
+def test_wiki_links():
+    t = format(DummyPage('mdown', "See [[some/page]] and [[other|this]]."))
+    assert '<a href="/some/page" class="wikilink">some/page</a>' in t
+    assert '<a href="/other" class="wikilink">this</a>' in t
+    t = format(DummyPage('html', "<code>[[some/page]]</code>"))
+    assert t == "<code>[[some/page]]</code>"
+
+def test_heading_anchors():
+    t = format(DummyPage('mdown', "# Some Title\n\n# Some Title"))
+    assert '<a class="anchor" id="some-title"></a><h1>Some Title</h1>' in t
+    assert 'id="some-title-1"' in t
+
+def test_sanitize():
+    t = format(DummyPage('html', '<p onclick="evil()">text</p>'
+        '<script>evil()</script><a href="javascript:evil()">link</a>'))
+    assert t == '<p>text</p><a>link</a>'
+    # malformed tags browsers would still run
+    t = format(DummyPage('html', "<img src=x onerror=alert(1) '>"))
+    assert t == "&lt;img src=x onerror=alert(1) '>"
+    t = format(DummyPage('html', '<a href="java&#9;script:evil()">link</a>'))
+    assert t == '<a>link</a>'
+
+def test_pipeline_timings():
+    pipeline = Pipeline([table_class])
+    pipeline.process('<table></table>', timed=True)
+    assert pipeline.timings['tokenize'][1] == 1
+    assert pipeline.timings['table_class'][1] == 1
@@ -0,0 +1,123 @@
+from __future__ import unicode_literals
+import os
+import signal
+from shutil import rmtree
+from subprocess import check_call, call, CalledProcessError
+from tempfile import mkdtemp
+from . import setups
+from nose import with_setup
+from nose.plugins.skip import SkipTest
+from giki.core import Wiki
+from giki.web import SingleUserWiki
+from giki.server import Server
+from giki.git_http import GitHTTP
+from dulwich.protocol import pkt_line
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+def make_app():
+    return SingleUserWiki(Wiki(setups.BARE_REPO_PATH), setups.EXAMPLE_AUTHOR)
+
+def serve():
+    """Starts a server for the test repo in another process, returning its
+    pid and URL.
+    """
+    server = Server(make_app, port=0, workers=1, threads=2)
+    host, port = server.bind()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+    server.socket.close()
+    return pid, 'http://{}:{}/+git'.format(host, port)
+
+def git(*args, **kwargs):
+    with open(os.devnull, 'w') as devnull:
+        return check_call(('git',) + args, stdout=devnull, stderr=devnull,
+                **kwargs)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_clone_and_push():
+    with open(os.devnull, 'w') as devnull:
+        if call(['git', '--version'], stdout=devnull) != 0:
+            raise SkipTest('git is not installed')
+
+    pid, url = serve()
+    tmp = mkdtemp()
+    try:
+        for name in ('a', 'b'):
+            # the second clone is served from the pack cache
+            git('clone', url, os.path.join(tmp, name))
+        clone = os.path.join(tmp, 'a')
+        with open(os.path.join(clone, 'index.mdown')) as f:
+            assert f.read() == setups.EXAMPLE_TEXT
+        w = Wiki(setups.BARE_REPO_PATH)
+        assert os.listdir(w._data_path('pack-cache'))
+
+        with open(os.path.join(clone, 'index.mdown'), 'w') as f:
+            f.write('# Pushed\n')
+        git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                'commit', '-am', 'Push', cwd=clone)
+        git('push', 'origin', 'master', cwd=clone)
+        assert w.get_page('index').content == '# Pushed\n'
+
+        # a push that would throw away a change made on the web is refused
+        p = w.get_page('index')
+        p.content = 'Saved on the web\n'
+        p.save(setups.EXAMPLE_AUTHOR)
+        with open(os.path.join(clone, 'index.mdown'), 'w') as f:
+            f.write('# Pushed again\n')
+        git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                'commit', '-am', 'Push again', cwd=clone)
+        try:
+            git('push', 'origin', 'master', cwd=clone)
+        except CalledProcessError:
+            pass
+        assert w.get_page('index').content == 'Saved on the web\n'
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        rmtree(tmp)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_push_chunked():
+    with open(os.devnull, 'w') as devnull:
+        if call(['git', '--version'], stdout=devnull) != 0:
+            raise SkipTest('git is not installed')
+
+    pid, url = serve()
+    tmp = mkdtemp()
+    try:
+        clone = os.path.join(tmp, 'a')
+        git('clone', url, clone)
+        # more than git's http.postBuffer, so git sends it chunked
+        with open(os.path.join(clone, 'big.mdown'), 'w') as f:
+            f.write(os.urandom(2 * 1024 * 1024).encode('hex'))
+        git('add', 'big.mdown', cwd=clone)
+        git('-c', 'user.name=Test', '-c', 'user.email=test@example.com',
+                'commit', '-m', 'Big push', cwd=clone)
+        git('push', 'origin', 'master', cwd=clone)
+        w = Wiki(setups.BARE_REPO_PATH)
+        assert len(w.get_page('big').content) == 4 * 1024 * 1024
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        rmtree(tmp)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_pack_cache():
+    w = Wiki(setups.BARE_REPO_PATH)
+    c = Client(SingleUserWiki(w, setups.EXAMPLE_AUTHOR), BaseResponse)
+    head = w._resolve_ref(w._ref)
+    want = b'want {} side-band-64k thin-pack ofs-delta\n'.format(head)
+    body = pkt_line(want) + pkt_line(None) + pkt_line(b'done\n')
+    responses = [c.post('/+git/git-upload-pack', data=body,
+        content_type='application/x-git-upload-pack-request').data
+        for i in range(2)]
+    assert responses[0] == responses[1]
+    assert b'PACK' in responses[0]
+    assert len(os.listdir(w._data_path('pack-cache'))) == 1
+    # the locks for cached packs aren't kept once they're served
+    assert not GitHTTP._pack_locks
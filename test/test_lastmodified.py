@@ -0,0 +1,88 @@
+from __future__ import unicode_literals
+from . import setups
+from time import sleep, time
+from nose import with_setup
+from giki.core import Wiki
+from giki.lastmodified import LastModifiedIndex
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_last_modified():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LastModifiedIndex(w)
+    first = w._resolve_ref(w._ref)
+    files = ['index.mdown', 'test/test.mdown', 'nope.mdown']
+    modified = i.lookup(files)
+    assert modified['index.mdown'][1] == first
+    assert modified['test/test.mdown'][2] == setups.EXAMPLE_AUTHOR
+    assert modified['nope.mdown'] is None
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('test/test', 'Changed\n')
+        t.put('new', 'New\n', 'mdown')
+    modified = i.lookup(files + ['new.mdown'])
+    assert modified['index.mdown'][1] == first
+    assert modified['test/test.mdown'][1] == t.commit_id
+    assert modified['new.mdown'][1] == t.commit_id
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.delete('new')
+    assert i.lookup(['new.mdown'])['new.mdown'] is None
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_last_modified_merge():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LastModifiedIndex(w)
+    stale = w.get_page('index')
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('test/test', 'Changed\n')
+    i.lookup([])
+    resets = []
+    reset = i._reset
+    i._reset = lambda: (resets.append(True), reset())
+
+    # saving a page loaded before that commit merges it with the head,
+    # whose commit the index has already seen
+    stale.content = 'Merged\n'
+    stale.save(setups.EXAMPLE_AUTHOR)
+    merge = w._resolve_ref(w._ref)
+    assert len(w._get_object(merge).parents) == 2
+    modified = i.lookup(['index.mdown', 'test/test.mdown'])
+    assert not resets
+    assert modified['index.mdown'][1] == merge
+    assert modified['test/test.mdown'][1] == t.commit_id
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_last_modified_rewritten():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LastModifiedIndex(w)
+    first = w._resolve_ref(w._ref)
+    p = w.get_page('index')
+    p.content = 'Changed\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    assert i.lookup(['index.mdown'])['index.mdown'][1] != first
+
+    # move the branch back; the index notices it's no longer behind it
+    w._repo.refs[w._ref] = first
+    assert i.lookup(['index.mdown'])['index.mdown'][1] == first
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_last_modified_background():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LastModifiedIndex(w)
+    head = w._resolve_ref(w._ref)
+    assert i.lookup_at(['index.mdown'], head) is None
+    i.start()
+    deadline = time() + 5
+    while i.lookup_at(['index.mdown'], head) is None and time() < deadline:
+        sleep(0.01)
+    assert i.lookup_at(['index.mdown'], head)['index.mdown'][1] == head
+
+    # it follows the branch as it moves
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('index', 'Changed\n')
+    deadline = time() + 5
+    while i.lookup_at(['index.mdown'], t.commit_id) is None and \
+            time() < deadline:
+        sleep(0.01)
+    assert i.lookup_at(['index.mdown'], t.commit_id)['index.mdown'][1] == \
+            t.commit_id
@@ -0,0 +1,94 @@
+from __future__ import unicode_literals
+from . import setups
+from nose import with_setup
+from dulwich.objects import Blob, Commit
+from giki.core import Wiki
+from giki.formatter import format_links
+from giki.links import LinkIndex
+
+def test_format_links():
+    assert format_links('mdown', '[a](b) and [[c|d]]\n') == ['b', '/c']
+    assert format_links('rst', '`a <b>`_ and [[c]]\n') == ['b', '/c']
+    assert format_links('textile', '"a":b') == ['b']
+    assert format_links('html', '<a href="b">a</a>') == ['b']
+    assert format_links('txt', '[[a]]') == []
+    # read from the markup, skipping images and code
+    assert format_links('mdown', '![i](i.png) `[[a]]` [r][1]\n\n'
+            '```\n[b](b)\n```\n[1]: c\n') == ['c']
+    assert format_links('rst', '.. _t: b\n') == ['b']
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_link_index():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LinkIndex(w)
+    assert i.orphans() == ['test/test']
+    assert i.backlinks('test/test') == []
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        # relative, absolute, wiki and external links, and one to itself
+        t.put('test/a', '[b](b) [[index]] [x](http://example.com/x) '
+                '[[test/a]]\n', 'mdown')
+        t.put('test/b', '[test](/test/test) [home](/) [[test/a|Test A]]\n',
+                'mdown')
+    assert i.backlinks('test/b') == ['test/a']
+    assert i.backlinks('test/test') == ['test/b']
+    assert i.backlinks('index') == ['test/a', 'test/b']
+    assert i.backlinks('test/a') == ['test/b']
+    assert i.orphans() == []
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('test/b', 'No links any more\n')
+        t.delete('test/a')
+    assert i.backlinks('test/b') == []
+    assert i.backlinks('index') == []
+    assert i.orphans() == ['test/b', 'test/test']
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_link_index_shared_blob():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LinkIndex(w)
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('a/one', '[[test/test]]\n', 'mdown')
+        t.put('b/one', '[[test/test]]\n', 'mdown')
+    assert i.backlinks('test/test') == ['a/one', 'b/one']
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.delete('a/one')
+    assert i.backlinks('test/test') == ['b/one']
+
+    # the links are saved with the index
+    i.save()
+    i = LinkIndex(w)
+    i._load()
+    assert i.backlinks('test/test') == ['b/one']
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_link_index_shadowed_file():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = LinkIndex(w)
+    # a.rst isn't shown, as a.mdown comes first
+    r = w._repo
+    head = r[w._resolve_ref(w._ref)]
+    tree = r[head.tree]
+    for name, content in ((b'a.mdown', b'Nothing\n'),
+            (b'a.rst', b'[[test/test]]\n')):
+        blob = Blob.from_string(content)
+        r.object_store.add_object(blob)
+        tree.add(name, 0100644, blob.id)
+    r.object_store.add_object(tree)
+    commit = Commit()
+    commit.tree = tree.id
+    commit.parents = [head.id]
+    commit.author = commit.committer = setups.EXAMPLE_AUTHOR
+    commit.commit_time = commit.author_time = head.commit_time
+    commit.commit_timezone = commit.author_timezone = 0
+    commit.message = b'Shadowed page'
+    r.object_store.add_object(commit)
+    r.refs[w._ref] = commit.id
+    assert w.get_page('a').fmt == 'mdown'
+    assert i.backlinks('test/test') == []
+
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.delete('a')
+    # and now it is
+    assert w.get_page('a').fmt == 'rst'
+    assert i.backlinks('test/test') == ['a']
@@ -0,0 +1,62 @@
+from __future__ import unicode_literals
+from . import setups
+from nose import with_setup
+from giki.core import Wiki, _LockedObjectStore
+from giki.maintenance import Maintainer, _loose_objects
+
+def _loose_count(w):
+    return len(list(_loose_objects(w._repo.object_store)))
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_maintain():
+    w = Wiki(setups.BARE_REPO_PATH)
+    w.get_page('index') # so the wiki has listed the packs, which there aren't
+    for i in range(3):
+        p = w.get_page('test/test')
+        p.content = 'Edit {}\n'.format(i)
+        p.save(setups.EXAMPLE_AUTHOR)
+    loose = _loose_count(w)
+    assert loose > 0
+
+    # below the threshold, nothing happens
+    assert Maintainer(w).maintain() == 0
+    assert _loose_count(w) == loose
+
+    # packs of two objects at most
+    assert Maintainer(w, batch_size=2).maintain(force=True) == loose
+    assert _loose_count(w) == 0
+    assert len(w._repo.object_store.packs) == (loose + 1) // 2
+
+    # a fresh wiki and the one that was open all along both see the packs
+    w._objects.clear()
+    for wiki in (w, Wiki(setups.BARE_REPO_PATH)):
+        assert wiki.get_page('test/test').content == 'Edit 2\n'
+        assert wiki.get_page('index').content == setups.EXAMPLE_TEXT
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_maintain_locked():
+    w = Wiki(setups.BARE_REPO_PATH)
+    other = Maintainer(w)
+    lock = other._lock()
+    assert lock is not None
+    try:
+        assert Maintainer(w).maintain(force=True) is None
+        assert _loose_count(w) == 4
+    finally:
+        lock.close()
+    assert Maintainer(w).maintain(force=True) == 4
+
+class _PackingStore (object):
+    """Misses an object the first time, as if it were packed mid-lookup."""
+    def __init__(self):
+        self.lookups = 0
+
+    def __getitem__(self, id):
+        self.lookups += 1
+        if self.lookups == 1:
+            raise KeyError(id)
+        return 'object'
+
+def test_object_packed_during_lookup():
+    store = _LockedObjectStore(_PackingStore())
+    assert store['a' * 40] == 'object'
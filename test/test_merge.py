@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+from giki.merge import merge3
+
+BASE = 'one\ntwo\nthree\nfour\nfive\n'
+
+def test_clean():
+    text, conflicts = merge3(BASE, 'one\nTWO\nthree\nfour\nfive\n',
+            'one\ntwo\nthree\nfour\nFIVE\n')
+    assert text == 'one\nTWO\nthree\nfour\nFIVE\n'
+    assert conflicts == []
+
+def test_same_change():
+    text, conflicts = merge3(BASE, 'one\nTWO\nthree\nfour\nfive\n',
+            'one\nTWO\nthree\nfour\nfive\n')
+    assert text == 'one\nTWO\nthree\nfour\nfive\n'
+    assert conflicts == []
+
+def test_insert_and_delete():
+    text, conflicts = merge3(BASE, 'one\nfive\n', BASE + 'six\n')
+    assert text == 'one\nfive\nsix\n'
+    assert conflicts == []
+
+def test_conflict():
+    text, conflicts = merge3(BASE, 'one\nours\nthree\nfour\nfive\n',
+            'one\ntheirs\nthree\nfour\nfive\n')
+    assert text == ('one\n<<<<<<< yours\nours\n=======\ntheirs\n'
+            '>>>>>>> theirs\nthree\nfour\nfive\n')
+    conflict, = conflicts
+    assert conflict.start == 1
+    assert conflict.base == ['two\n']
+    assert conflict.ours == ['ours\n']
+    assert conflict.theirs == ['theirs\n']
@@ -0,0 +1,56 @@
+from __future__ import unicode_literals
+from time import sleep
+from . import setups
+from nose import with_setup
+from giki.core import Wiki
+from giki.cache import RenderCache
+from giki.prerender import Prerenderer
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_ref_listener():
+    w = Wiki(setups.BARE_REPO_PATH)
+    moves = []
+    w.add_ref_listener(lambda old, new: moves.append((old, new)))
+    before = w._resolve_ref(w._ref)
+    p = w.get_page('index')
+    p.content = 'Changed\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    after = w._resolve_ref(w._ref)
+    assert moves == [(before, after)]
+
+    # a move made elsewhere is noticed the next time we look
+    other = Wiki(setups.BARE_REPO_PATH)
+    p = other.get_page('index')
+    p.content = 'Changed again\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    w.get_page('index')
+    assert moves[1:] == [(after, other._resolve_ref(w._ref))]
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_prerender():
+    w = Wiki(setups.BARE_REPO_PATH)
+    cache = RenderCache()
+    before = w._resolve_ref(w._ref)
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('index', '# Changed\n')
+        t.put('new/page', '# New\n', 'mdown')
+    prerenderer = Prerenderer(w, cache)
+    assert prerenderer.prerender(before, t.commit_id) == 2
+    assert '<h1>New</h1>' in cache.lookup(w.get_page('new/page'))
+    assert cache.lookup(w.get_page('test/test')) is None
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_prerender_on_save():
+    w = Wiki(setups.BARE_REPO_PATH)
+    cache = RenderCache()
+    Prerenderer(w, cache).start()
+    w.get_page('index')
+    p = w.get_page('index')
+    p.content = '# Changed\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    p = w.get_page('index')
+    for i in range(50):
+        if cache.lookup(p) is not None:
+            break
+        sleep(0.1)
+    assert '<h1>Changed</h1>' in cache.lookup(p)
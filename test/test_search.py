@@ -0,0 +1,32 @@
+from __future__ import unicode_literals
+from . import setups
+from nose import with_setup
+from giki.core import Wiki
+from giki.search import SearchIndex
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_search():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = SearchIndex(w)
+    assert i.search('example') == ['index', 'test/test']
+    assert i.search('nothing') == []
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_search_incremental():
+    w = Wiki(setups.BARE_REPO_PATH)
+    i = SearchIndex(w)
+    i.search('example')
+    p = w.get_page('test/test')
+    p.content = 'Something else entirely\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    assert i.search('example') == ['index']
+    assert i.search('ENTIRELY something') == ['test/test']
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_search_persisted():
+    w = Wiki(setups.BARE_REPO_PATH)
+    SearchIndex(w).search('example')
+    i = SearchIndex(w)
+    i._load()
+    assert i.commit_id == w._repo.refs['refs/heads/master']
+    assert i.search('example') == ['index', 'test/test']
@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+import os
+import signal
+from httplib import HTTPConnection
+from . import setups
+from nose import with_setup
+from nose.plugins.skip import SkipTest
+from giki.core import Wiki
+from giki.web import SingleUserWiki
+from giki.server import Server, GeventServer
+
+def make_app():
+    return SingleUserWiki(Wiki(setups.BARE_REPO_PATH), setups.EXAMPLE_AUTHOR)
+
+def check_server(server):
+    host, port = server.bind()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server.serve_forever()
+        finally:
+            os._exit(0)
+
+    try:
+        server.socket.close()
+        c = HTTPConnection(host, port, timeout=10)
+        # two requests on the same connection
+        for i in range(2):
+            c.request('GET', '/index')
+            r = c.getresponse()
+            assert r.status == 200
+            assert '<h1>Example</h1>' in r.read()
+            assert not r.will_close
+        c.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        assert os.waitpid(pid, 0)[1] == 0
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_serve():
+    check_server(Server(make_app, port=0, workers=2, threads=2))
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_serve_gevent():
+    try:
+        import gevent
+    except ImportError:
+        raise SkipTest('gevent is not installed')
+    check_server(GeventServer(make_app, port=0, workers=2, threads=2))
+
+def test_failing_workers():
+    def make_app():
+        raise IOError('no such wiki')
+    server = Server(make_app, port=0, workers=1)
+    server.respawn_delay = 0.01
+    server.bind()
+    pid = os.fork()
+    if pid == 0:
+        # keep the workers' tracebacks out of the test output
+        with open(os.devnull, 'w') as devnull:
+            os.dup2(devnull.fileno(), 2)
+        try:
+            server.serve_forever()
+        except RuntimeError:
+            os._exit(1)
+        finally:
+            os._exit(0)
+
+    server.socket.close()
+    # the master gives up rather than respawning workers forever
+    status = os.waitpid(pid, 0)[1]
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 1
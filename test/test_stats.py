@@ -0,0 +1,61 @@
+from __future__ import unicode_literals
+import json
+from . import setups
+from nose import with_setup
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+from giki import stats
+from giki.core import Wiki
+from giki.web import SingleUserWiki
+
+def test_histogram():
+    h = stats.Histogram()
+    assert h.percentile(50) is None
+    for ms in range(1, 101):
+        h.add(ms / 1000.0)
+    # buckets are within 19% of each other
+    assert 0.050 <= h.percentile(50) < 0.050 * 1.19
+    assert 0.099 <= h.percentile(99) < 0.099 * 1.19
+    assert h.percentile(100) == 0.1
+    summary = h.summary()
+    assert summary['count'] == 100
+    assert summary['mean'] == 50.5
+
+def test_timer_disabled():
+    assert stats.current() is None
+    with stats.timer('ref'):
+        pass
+    timings = stats.start()
+    try:
+        with stats.timer('format', 'mdown'):
+            pass
+        with stats.timer('format', 'mdown'):
+            pass
+    finally:
+        stats.stop()
+    assert timings.stages[('format', 'mdown')][1] == 2
+    assert timings.header().startswith('format;desc="mdown";dur=')
+    assert stats.current() is None
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_server_timing():
+    w = Wiki(setups.BARE_REPO_PATH)
+    c = Client(SingleUserWiki(w, setups.EXAMPLE_AUTHOR), BaseResponse)
+    assert 'Server-Timing' not in c.get('/index').headers
+    assert c.get('/+stats').status_code == 404
+
+    app = SingleUserWiki(w, setups.EXAMPLE_AUTHOR)
+    app.stats = stats.Stats()
+    c = Client(app, BaseResponse)
+    header = c.get('/index').headers['Server-Timing']
+    names = [part.split(';')[0] for part in header.split(', ')]
+    for name in ('ref', 'trees', 'blob', 'format', 'postprocess', 'template',
+            'total'):
+        assert name in names
+    assert 'desc="mdown"' in header
+
+    report = json.loads(c.get('/+stats').data)
+    assert report['endpoints']['show_page']['count'] == 1
+    assert report['stages']['format/mdown']['count'] == 1
+    assert report['stages']['postprocess/tokenize']['count'] == 1
+    assert report['stages']['ref']['p99'] is not None
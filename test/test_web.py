@@ -0,0 +1,264 @@
+from __future__ import unicode_literals
+import os
+import zlib
+from shutil import rmtree
+from tempfile import mkdtemp
+from . import setups
+from nose import with_setup
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse, Response
+from giki import core
+from giki.cache import LRUCache, RenderCache
+from giki.core import Wiki
+from giki.web import SingleUserWiki
+from giki.web_framework import WebApp, get
+
+def get_client():
+    w = Wiki(setups.BARE_REPO_PATH)
+    return w, Client(SingleUserWiki(w, setups.EXAMPLE_AUTHOR), BaseResponse)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_show_page():
+    w, c = get_client()
+    r = c.get('/index')
+    assert r.status_code == 200
+    assert '<h1>Example</h1>' in r.data
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_not_found():
+    w, c = get_client()
+    assert c.get('/nope').status_code == 404
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_etag():
+    w, c = get_client()
+    r = c.get('/index')
+    etag = r.headers['ETag']
+    r = c.get('/index', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.data == ''
+
+    p = w.get_page('index')
+    p.content = 'Changed\n'
+    p.save(setups.EXAMPLE_AUTHOR)
+    r = c.get('/index', headers={'If-None-Match': etag})
+    assert r.status_code == 200
+    assert r.headers['ETag'] != etag
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_last_modified():
+    w, c = get_client()
+    # page views don't wait for the index to be brought up to date
+    index = c.application.last_modified
+    assert 'Last-Modified' not in c.get('/index').headers
+    index.update()
+    last_modified = c.get('/index').headers['Last-Modified']
+    r = c.get('/index', headers={'If-Modified-Since': last_modified})
+    assert r.status_code == 304
+
+    # a later commit to another page doesn't change this one's time
+    time = core.time
+    core.time = lambda: time() + 60
+    try:
+        with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+            t.put('other', 'Other\n', 'mdown')
+    finally:
+        core.time = time
+    index.update()
+    assert c.get('/index').headers['Last-Modified'] == last_modified
+    assert c.get('/other').headers['Last-Modified'] != last_modified
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_compress():
+    w, c = get_client()
+    p = w.get_page('index')
+    p.content = 'A long paragraph of text.\n\n' * 200
+    p.save(setups.EXAMPLE_AUTHOR)
+    c.application.compress = True
+
+    plain = c.get('/index')
+    assert 'Content-Encoding' not in plain.headers
+    for i in range(2):
+        # the second request comes from the compression cache
+        r = c.get('/index', headers={'Accept-Encoding': 'gzip, deflate'})
+        assert r.headers['Content-Encoding'] == 'gzip'
+        assert r.headers['Vary'] == 'Accept-Encoding'
+        assert int(r.headers['Content-Length']) == len(r.data)
+        assert zlib.decompress(r.data, 16 + zlib.MAX_WBITS) == plain.data
+
+    r = c.get('/index', headers={'Accept-Encoding': 'gzip;q=0'})
+    assert 'Content-Encoding' not in r.headers
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_compress_http_exception():
+    w, c = get_client()
+    c.application.compress = True
+    headers = {'Accept-Encoding': 'gzip'}
+    # views raising HTTP exceptions for missing form fields
+    assert c.post('/+create', headers=headers).status_code == 400
+    assert c.post('/+search', headers=headers).status_code == 400
+
+def test_compress_weak_etag():
+    class App (WebApp):
+        body = 'first ' * 500
+
+        @get('/')
+        def page(self, request):
+            r = Response(self.body)
+            r.set_etag('same', weak=True)
+            return r
+
+    app = App()
+    app.compress = True
+    app.compression_cache = LRUCache()
+    c = Client(app, BaseResponse)
+    headers = {'Accept-Encoding': 'gzip'}
+    for body in ('first ' * 500, 'second ' * 500):
+        # bodies with the same weak ETag can differ
+        app.body = body
+        r = c.get('/', headers=headers)
+        assert zlib.decompress(r.data, 16 + zlib.MAX_WBITS) == body
+
+def test_compress_strong_etag():
+    class App (WebApp):
+        @get('/')
+        def page(self, request):
+            not_modified = self.not_modified(request, 'tag')
+            if not_modified is not None:
+                return not_modified
+            r = Response('body ' * 500)
+            r.set_etag('tag')
+            return r
+
+    app = App()
+    app.compress = True
+    c = Client(app, BaseResponse)
+    assert c.get('/').headers['ETag'] == '"tag"'
+    # each encoding of the body gets its own strong ETag
+    etag = c.get('/', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    assert etag == '"tag-gzip"'
+    r = c.get('/', headers={'Accept-Encoding': 'gzip',
+        'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_compress_memory_only():
+    path = mkdtemp()
+    try:
+        w = Wiki(setups.BARE_REPO_PATH)
+        app = SingleUserWiki(w, setups.EXAMPLE_AUTHOR,
+                render_cache=RenderCache(path=path))
+        app.compress = True
+        p = w.get_page('index')
+        p.content = 'A long paragraph of text.\n\n' * 200
+        p.save(setups.EXAMPLE_AUTHOR)
+        c = Client(app, BaseResponse)
+        c.get('/index', headers={'Accept-Encoding': 'gzip'})
+        # only the rendered page is written to disk
+        assert len(os.listdir(path)) == 1
+    finally:
+        rmtree(path)
+
+def test_url_map_per_class():
+    class App (WebApp):
+        @get('/a')
+        def a(self, request):
+            return Response('a')
+
+        @get('/b')
+        def b(self, request):
+            return Response('b')
+
+        def handle_not_found(self, request):
+            return Response('not found', status=404)
+
+    class SubApp (App):
+        @get('/c')
+        def a(self, request):
+            return Response('c')
+
+        b = None
+
+    assert App._url_map is not SubApp._url_map
+    c = Client(App(), BaseResponse)
+    assert c.get('/a').data == 'a'
+    assert c.get('/b').data == 'b'
+    c = Client(SubApp(), BaseResponse)
+    assert c.get('/c').data == 'c'
+    assert c.get('/a').status_code == 404
+    assert c.get('/b').status_code == 404
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_template_cache():
+    path = mkdtemp()
+    try:
+        w = Wiki(setups.BARE_REPO_PATH)
+        app = SingleUserWiki(w, setups.EXAMPLE_AUTHOR, template_cache=path)
+        app.precompile_templates()
+        assert len(os.listdir(path)) == len(app.template_env.list_templates())
+        assert app.template_env is not SingleUserWiki.template_env
+
+        # a fresh app loads the compiled templates rather than the sources
+        app = SingleUserWiki(w, setups.EXAMPLE_AUTHOR, template_cache=path)
+        r = Client(app, BaseResponse).get('/index')
+        assert '<h1>Example</h1>' in r.data
+    finally:
+        rmtree(path)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_list_pages():
+    w, c = get_client()
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('test/other', '<p>Other</p>', 'html')
+    r = c.get('/+index/')
+    assert r.status_code == 200
+    assert "href='/+index/test'" in r.data
+    assert "href='/index'" in r.data
+
+    r = c.get('/+index/test')
+    assert "href='/test/other'" in r.data
+    assert 'HTML' in r.data and 'Markdown' in r.data
+    r = c.get('/+index/test', headers={'If-None-Match': r.headers['ETag']})
+    assert r.status_code == 304
+
+    assert c.get('/+index/nope').status_code == 404
+    assert c.get('/+index/index').status_code == 404
+    # the editor's script is only on pages with an editor
+    assert 'CodeMirror.fromTextArea' not in c.get('/+index/').data
+    assert 'CodeMirror.fromTextArea' in c.get('/index').data
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_backlinks():
+    w, c = get_client()
+    with w.transaction(setups.EXAMPLE_AUTHOR) as t:
+        t.put('index', 'See [[test/test]]\n')
+    r = c.get('/+links/test/test')
+    assert r.status_code == 200
+    assert "href='/index'" in r.data
+    assert c.get('/+links/nope').status_code == 404
+    assert 'Every page is linked to' in c.get('/+orphans').data
+
+class _RecordingPool (object):
+    """Stands in for a gevent thread pool, noting what's passed to it."""
+    def __init__(self):
+        self.calls = []
+
+    def apply(self, func, args, kwargs):
+        self.calls.append(getattr(func, '__name__', func))
+        return func(*args, **kwargs)
+
+@with_setup(setups.setup_bare_with_page, setups.teardown_bare)
+def test_offload_writes():
+    w, c = get_client()
+    pool = c.application.offload_pool = _RecordingPool()
+    commit_id = w._resolve_ref(w._ref)
+    r = c.post('/index', data={'commit_id': commit_id,
+        'content': 'Changed\n', 'commit_msg': ''})
+    assert r.status_code == 302
+    assert pool.calls == ['save']
+    assert w.get_page('index').content == 'Changed\n'
+
+    pool.calls = []
+    c.post('/+create', data={'path': 'new'})
+    assert pool.calls == ['create_page']